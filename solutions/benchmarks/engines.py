@@ -0,0 +1,137 @@
+"""
+Benchmark of the similarity engines over a range of playlist sizes.
+
+For every playlist size the sklearn pipeline (tree-based search) and the
+NumPy engine (brute force) are fitted on random tracks and queried with a
+fixed number of top user songs, as a /predict request does. The crossover
+is the smallest size at which the tree is faster than NumPy. Fitted models
+are cached, so the crossover of the query alone is what most requests see
+and is a good value for MODEL_ENGINE_THRESHOLD. Run it from the solutions
+directory:
+
+    python -m benchmarks.engines
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from src.catalog import FEATURE_RANGES  # noqa: E402
+from src.spotify import MusicModel  # noqa: E402
+
+SIZES = [50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000]
+
+
+def random_tracks(n: int, rng: np.random.Generator) -> pd.DataFrame:
+    """ Returns n tracks with uniformly distributed audio features. """
+    return pd.DataFrame(
+        {
+            feature: rng.uniform(low, high, n)
+            for feature, (low, high) in FEATURE_RANGES.items()
+        }
+    )
+
+
+def best_of(fn: Callable, repeat: int) -> float:
+    """ Returns the fastest of `repeat` runs of fn, in seconds. """
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def run(sizes: List[int], n_queries: int, repeat: int) -> List[Dict]:
+    """ Times fitting and querying both engines for every playlist size.
+
+    :param sizes: Playlist sizes.
+    :param n_queries: Number of top user songs per query.
+    :param repeat: Number of runs per measurement, of which the fastest is kept.
+    :return: List of dictionaries with the timings in ms per size and engine.
+    """
+    rng = np.random.default_rng(0)
+    queries = random_tracks(n_queries, rng)
+    music_model = MusicModel(lazy=True)
+    results = []
+
+    for size in sizes:
+        tracks = random_tracks(size, rng)
+        result = {"size": size}
+
+        for engine in ("sklearn", "numpy"):
+            music_model.engine = engine
+            model = music_model.fit_model(tracks)
+
+            result[f"{engine}_fit_ms"] = (
+                best_of(lambda: music_model.fit_model(tracks), repeat) * 1000
+            )
+            result[f"{engine}_query_ms"] = (
+                best_of(lambda: model.predict(queries), repeat) * 1000
+            )
+
+        results.append(result)
+        print(
+            f"{size:>8}  "
+            f"sklearn fit {result['sklearn_fit_ms']:8.3f} ms  "
+            f"query {result['sklearn_query_ms']:8.3f} ms    "
+            f"numpy fit {result['numpy_fit_ms']:8.3f} ms  "
+            f"query {result['numpy_query_ms']:8.3f} ms"
+        )
+
+    return results
+
+
+def crossover(results: List[Dict], stages: List[str]) -> Optional[int]:
+    """ Returns the smallest playlist size at which the tree-based engine is
+    faster, or None if NumPy is faster for all sizes.
+
+    :param results: Timings as returned by `run`.
+    :param stages: Stages to add up, 'fit' and/or 'query'.
+    :return: Playlist size.
+    """
+    for result in results:
+        sklearn_ms = sum(result[f"sklearn_{stage}_ms"] for stage in stages)
+        numpy_ms = sum(result[f"numpy_{stage}_ms"] for stage in stages)
+
+        if sklearn_ms < numpy_ms:
+            return result["size"]
+
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # The model creates its feature store in the working directory.
+    workdir = tempfile.mkdtemp(prefix="music-bench-")
+    os.chdir(workdir)
+
+    try:
+        results = run(args.sizes, args.queries, args.repeat)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\nCrossover query:       {crossover(results, ['query']) or 'none'}")
+    print(f"Crossover fit + query: {crossover(results, ['fit', 'query']) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
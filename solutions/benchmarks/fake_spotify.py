@@ -0,0 +1,164 @@
+"""
+Local stand-in for the Spotify Web API endpoints used by the MusicModel.
+
+`FakeSpotify` mimics the spotipy client and `FakeSpotify.transport()` serves
+the same data over an httpx transport for the asynchronous client. Every
+call waits `latency` seconds, and audio features are derived from the track
+id, so all runs see the same data.
+"""
+
+import asyncio
+import random
+import time
+import zlib
+
+from typing import Dict, List, Optional
+
+import httpx
+
+
+class FakeSpotify:
+    def __init__(self, playlist_size: int = 100, latency: float = 0.05):
+        """
+        :param playlist_size: Number of tracks in every playlist.
+        :param latency: Seconds every call takes.
+        """
+        self.playlist_size = playlist_size
+        self.latency = latency
+        self.page_size = 100
+        self.calls = 0
+
+    def _track(self, track_id: str) -> Dict:
+        return {
+            "id": track_id,
+            "name": f"Song {track_id}",
+            "artists": [{"name": f"Artist {zlib.crc32(track_id.encode()) % 50}"}],
+        }
+
+    def _page(self, playlist_id: str, offset: int, limit: int) -> Dict:
+        end = min(offset + limit, self.playlist_size)
+
+        return {
+            "items": [
+                {"track": self._track(f"{playlist_id}-{i}")} for i in range(offset, end)
+            ],
+            "offset": offset,
+            "limit": limit,
+            "total": self.playlist_size,
+            "next": None if end >= self.playlist_size else "next",
+        }
+
+    def _features(self, track_id: str) -> Dict:
+        rng = random.Random(track_id)
+
+        return {
+            "id": track_id,
+            "danceability": rng.random(),
+            "energy": rng.random(),
+            "loudness": -60 * rng.random(),
+            "speechiness": rng.random(),
+            "acousticness": rng.random(),
+            "instrumentalness": rng.random(),
+            "liveness": rng.random(),
+            "valence": rng.random(),
+            "tempo": 60 + 140 * rng.random(),
+        }
+
+    def _playlist(self, playlist_id: str) -> Dict:
+        return {
+            "id": playlist_id,
+            "snapshot_id": "snapshot",
+            "tracks": self._page(playlist_id, 0, self.page_size),
+        }
+
+    def _top_tracks(self, limit: int, time_range: str) -> Dict:
+        return {
+            "items": [self._track(f"top-{time_range}-{i}") for i in range(limit)],
+            "offset": 0,
+            "limit": limit,
+            "total": limit,
+            "next": None,
+        }
+
+    def _wait(self):
+        self.calls += 1
+        time.sleep(self.latency)
+
+    def playlist(self, playlist_id: str, **kwargs) -> Dict:
+        self._wait()
+
+        return self._playlist(playlist_id)
+
+    def playlist_items(
+        self, playlist_id: str, offset: int = 0, limit: int = 100, **kwargs
+    ) -> Dict:
+        self._wait()
+
+        return self._page(playlist_id, offset, limit)
+
+    def current_user_top_tracks(
+        self, limit: int = 20, offset: int = 0, time_range: str = "medium_term"
+    ) -> Dict:
+        self._wait()
+
+        return self._top_tracks(limit, time_range)
+
+    def audio_features(self, tracks: List[str]) -> List[Optional[Dict]]:
+        self._wait()
+
+        if len(tracks) > 100:
+            raise ValueError("At most 100 track ids are allowed")
+
+        return [self._features(track_id) for track_id in tracks]
+
+    def transport(self) -> httpx.AsyncBaseTransport:
+        """ Returns an httpx transport that serves this stand-in asynchronously. """
+
+        async def handle(request: httpx.Request) -> httpx.Response:
+            self.calls += 1
+            await asyncio.sleep(self.latency)
+
+            parts = request.url.path.strip("/").split("/")[1:]
+            params = request.url.params
+
+            if parts[0] == "playlists" and len(parts) == 2:
+                body = self._playlist(parts[1])
+            elif parts[0] == "playlists" and parts[2:] == ["tracks"]:
+                body = self._page(
+                    parts[1],
+                    int(params.get("offset", 0)),
+                    int(params.get("limit", self.page_size)),
+                )
+            elif parts == ["me", "top", "tracks"]:
+                body = self._top_tracks(
+                    int(params.get("limit", 20)),
+                    params.get("time_range", "medium_term"),
+                )
+            elif parts == ["audio-features"]:
+                body = {
+                    "audio_features": [
+                        self._features(track_id)
+                        for track_id in params["ids"].split(",")
+                    ]
+                }
+            else:
+                return httpx.Response(404, json={"error": {"message": "Not found"}})
+
+            return httpx.Response(200, json=body)
+
+        return httpx.MockTransport(handle)
+
+
+class FakeAuthManager:
+    """ Auth manager that always holds a valid access token. """
+
+    class cache_handler:
+        @staticmethod
+        def get_cached_token() -> Dict:
+            return {"access_token": "fake", "expires_at": time.time() + 3600}
+
+    def is_token_expired(self, token: Dict) -> bool:
+        return False
+
+    def get_access_token(self, as_dict: bool = False) -> str:
+        return "fake"
@@ -0,0 +1,270 @@
+"""
+Load-testing benchmark for the FastAPI app against a local Spotify stand-in.
+
+Every scenario sends `--requests` requests with at most `--concurrency` in
+flight and reports p50/p95/p99 latency and requests per second, with cold
+and warm caches. Run it from the solutions directory:
+
+    python -m benchmarks.run --output bench.json
+    python -m benchmarks.run --compare bench.json
+
+Cold playlist scenarios request a new playlist id every time, so each request
+ingests from the stand-in. Cold /most_listened requests clear the caches
+before every request and therefore run one at a time.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_spotify import FakeAuthManager, FakeSpotify  # noqa: E402
+
+# name, path, query parameters
+SCENARIOS = [
+    ("most_listened", "/most_listened", {"term": "short_term"}),
+    ("most_listened_debug", "/most_listened", {"term": "short_term", "debug": "true"}),
+    ("show_playlist", "/show_playlist", {}),
+    ("show_playlist_debug", "/show_playlist", {"debug": "true"}),
+    ("predict", "/predict", {"term": "short_term"}),
+]
+
+
+def percentile(values: List[float], p: float) -> float:
+    """ Returns the nearest-rank percentile of the given values. """
+    ordered = sorted(values)
+
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    n_requests: int,
+    concurrency: int,
+    make_request: Callable[[int], tuple],
+    before: Optional[Callable[[int], None]] = None,
+) -> Dict:
+    """ Sends requests and measures their latency.
+
+    :param client: Client connected to the app.
+    :param n_requests: Number of requests to send.
+    :param concurrency: Maximum number of requests in flight.
+    :param make_request: Returns the (path, params) of the i-th request.
+    :param before: Called before the i-th request is sent.
+    :return: Dictionary with latency percentiles in ms, requests per second
+        and the number of failed requests.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], []
+
+    async def send(i):
+        async with semaphore:
+            if before:
+                before(i)
+
+            path, params = make_request(i)
+            start = time.perf_counter()
+            response = await client.get(path, params=params)
+            latencies.append(time.perf_counter() - start)
+
+            if response.status_code != 200:
+                errors.append(response.status_code)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[send(i) for i in range(n_requests)])
+    elapsed = time.perf_counter() - start
+
+    return {
+        "requests": n_requests,
+        "concurrency": concurrency,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "rps": n_requests / elapsed,
+        "errors": len(errors),
+    }
+
+
+def reset(music_model):
+    """ Drops all cached data, in memory and on disk, except the default tracks. """
+    music_model.cache.clear()
+    music_model.models.clear()
+    music_model.track_features.clear()
+
+    for file in os.listdir(music_model.store_dir):
+        if file.startswith(("tracks_", "user_tracks_", "model_")):
+            os.remove(os.path.join(music_model.store_dir, file))
+
+
+async def run(args) -> List[Dict]:
+    """ Runs all scenarios against the app with a fresh copy of the data folder. """
+    from src.async_spotify import AsyncSpotify
+    from src.main import app, music_model
+
+    fake = FakeSpotify(playlist_size=args.playlist_size, latency=args.latency_ms / 1000)
+    music_model.spt = fake
+    music_model.aspt = AsyncSpotify(
+        FakeAuthManager(), transport=fake.transport(), limiter=music_model.limiter
+    )
+    music_model.limiter.rate = args.spotify_rate
+    music_model.ready = True
+
+    results = []
+    transport = httpx.ASGITransport(app=app)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for name, path, params in SCENARIOS:
+            if args.scenario and name not in args.scenario:
+                continue
+
+            for cache in ("cold", "warm"):
+                reset(music_model)
+                calls = fake.calls
+
+                if path == "/most_listened" and cache == "cold":
+                    result = await run_scenario(
+                        client,
+                        args.requests,
+                        1,
+                        lambda i: (path, params),
+                        before=lambda i: reset(music_model),
+                    )
+                elif cache == "cold":
+                    result = await run_scenario(
+                        client,
+                        args.requests,
+                        args.concurrency,
+                        lambda i: (path, {**params, "playlist_id": f"cold-{i}"}),
+                    )
+                else:
+                    await client.get(path, params=params)
+                    calls = fake.calls
+                    result = await run_scenario(
+                        client,
+                        args.requests,
+                        args.concurrency,
+                        lambda i: (path, params),
+                    )
+
+                result = {
+                    "scenario": name,
+                    "cache": cache,
+                    "spotify_calls": fake.calls - calls,
+                    **result,
+                }
+                results.append(result)
+                print(
+                    f"{name:<22}{cache:<6}"
+                    f"p50 {result['p50_ms']:8.2f} ms  p95 {result['p95_ms']:8.2f} ms  "
+                    f"p99 {result['p99_ms']:8.2f} ms  {result['rps']:9.1f} req/s  "
+                    f"errors {result['errors']}"
+                )
+
+    await music_model.aclose()
+
+    return results
+
+
+def compare(results: List[Dict], baseline_file: str):
+    """ Prints the change of every scenario relative to a previous run. """
+    with open(baseline_file) as f:
+        baseline = {
+            (r["scenario"], r["cache"]): r for r in json.load(f)["results"]
+        }
+
+    print(f"\nCompared to {baseline_file}:")
+    for result in results:
+        before = baseline.get((result["scenario"], result["cache"]))
+
+        if before is None:
+            continue
+
+        print(
+            f"{result['scenario']:<22}{result['cache']:<6}"
+            f"p50 {result['p50_ms'] / before['p50_ms']:6.2f}x  "
+            f"p99 {result['p99_ms'] / before['p99_ms']:6.2f}x  "
+            f"req/s {result['rps'] / before['rps']:6.2f}x"
+        )
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--playlist-size", type=int, default=100)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument(
+        "--spotify-rate",
+        type=float,
+        default=0,
+        help="Calls per second allowed to the stand-in, 0 for no limit.",
+    )
+    parser.add_argument(
+        "--scenario", action="append", help="Only run the given scenario(s)."
+    )
+    parser.add_argument("--output", help="Write the results as json to this file.")
+    parser.add_argument("--compare", help="Compare with the results in this file.")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="music-bench-")
+    shutil.copytree(
+        os.path.join(ROOT, "data"),
+        os.path.join(workdir, "data"),
+        ignore=lambda directory, files: [
+            f for f in files if f.startswith(("tracks_", "user_tracks_"))
+        ],
+    )
+    # --output and --compare are relative to the directory the benchmark
+    # was started from, so it is restored before they are opened.
+    cwd = os.getcwd()
+    os.chdir(workdir)
+
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
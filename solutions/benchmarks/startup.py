@@ -0,0 +1,222 @@
+"""
+Startup-time report of the FastAPI app, checked against a budget.
+
+Every run starts a fresh interpreter with a fresh copy of the data folder,
+imports `src.main`, runs the startup handlers and sends the first requests
+in process, so the numbers do not depend on the server in front of the app.
+The import time per module comes from `python -X importtime`. Run it from
+the solutions directory:
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --budget-import-ms 400 --output startup.json
+
+The exit code is 1 when the median import time or time to first response
+exceeds its budget, so the report can gate a CI job.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.run import git_revision  # noqa: E402
+
+# Modules that should only be imported on the code paths that need them.
+LAZY_MODULES = ["sklearn", "scipy"]
+
+# Runs in the fresh interpreter and prints the timings as json.
+CHILD = """
+import asyncio, json, sys, time
+
+start = time.perf_counter()
+from src.main import app
+imported = time.perf_counter()
+
+
+async def main():
+    import httpx
+
+    timings = {"import_ms": (imported - start) * 1000}
+
+    await app.router.startup()
+    timings["startup_ms"] = (time.perf_counter() - start) * 1000
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+        for name, path in PATHS:
+            response = await client.get(path)
+            response.raise_for_status()
+            timings[name + "_ms"] = (time.perf_counter() - start) * 1000
+
+    timings["loaded"] = [m for m in LAZY_MODULES if m in sys.modules]
+    await app.router.shutdown()
+
+    return timings
+
+
+print(json.dumps(asyncio.run(main())))
+"""
+
+# name, path of the first requests, in order
+PATHS = [
+    ("first_response", "/healthz"),
+    ("first_prediction", "/predict?term=short_term"),
+]
+
+
+def fresh_workdir() -> str:
+    """ Returns a temporary directory with a copy of the bundled data only. """
+    workdir = tempfile.mkdtemp(prefix="music-startup-")
+    shutil.copytree(
+        os.path.join(ROOT, "data"),
+        os.path.join(workdir, "data"),
+        ignore=lambda directory, files: [
+            f for f in files if f.startswith(("tracks_", "user_tracks_", "model_"))
+        ],
+    )
+
+    return workdir
+
+
+def run_python(args: List[str]) -> subprocess.CompletedProcess:
+    """ Runs a fresh interpreter in a fresh working directory. """
+    workdir = fresh_workdir()
+    env = {**os.environ, "PYTHONPATH": ROOT, "PYTHONDONTWRITEBYTECODE": "1"}
+
+    try:
+        return subprocess.run(
+            [sys.executable, *args],
+            cwd=workdir,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def import_times(min_ms: float) -> List[Dict]:
+    """ Returns the cumulative import time of the modules of the app and of
+    every top-level package, slowest first.
+
+    :param min_ms: Leave out modules that take less time to import.
+    :return: List of dictionaries with the module name and time in ms.
+    """
+    stderr = run_python(["-X", "importtime", "-c", "import src.main"]).stderr
+    modules = []
+
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+
+        _, cumulative, name = line.split("|")
+        name = name.strip()
+
+        if not cumulative.strip().isdigit():
+            continue
+
+        if name.startswith("src") or "." not in name and not name.startswith("_"):
+            ms = int(cumulative) / 1000
+            if ms >= min_ms:
+                modules.append({"module": name, "ms": ms})
+
+    return sorted(modules, key=lambda m: -m["ms"])
+
+
+def startup_times(repeat: int) -> List[Dict]:
+    """ Returns the timings of `repeat` cold starts.
+
+    :param repeat: Number of cold starts.
+    :return: List of dictionaries with the time in ms since the start of the
+        import for every stage, and the lazy modules that were loaded.
+    """
+    code = f"LAZY_MODULES = {LAZY_MODULES!r}\nPATHS = {PATHS!r}\n{CHILD}"
+    runs = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = run_python(["-c", code]).stdout
+        timings = json.loads(output.strip().splitlines()[-1])
+        timings["process_ms"] = (time.perf_counter() - start) * 1000
+        runs.append(timings)
+
+    return runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-ms", type=float, default=5.0)
+    parser.add_argument("--budget-import-ms", type=float, default=500.0)
+    parser.add_argument("--budget-first-response-ms", type=float, default=1000.0)
+    parser.add_argument("--output", help="Write the report as json to this file.")
+    args = parser.parse_args()
+
+    modules = import_times(args.min_ms)
+    runs = startup_times(args.repeat)
+
+    print("Import time per module (cumulative):")
+    for module in modules:
+        print(f"  {module['module']:<28}{module['ms']:9.1f} ms")
+
+    stages = ["import", "startup", *[name for name, _ in PATHS], "process"]
+    median = {
+        stage: statistics.median(run[f"{stage}_ms"] for run in runs)
+        for stage in stages
+    }
+
+    print(f"\nCold start, median of {args.repeat}:")
+    for stage in stages:
+        print(f"  {stage:<28}{median[stage]:9.1f} ms")
+
+    loaded = sorted({m for run in runs for m in run["loaded"]})
+    print(f"\nLazy modules loaded by the first requests: {', '.join(loaded) or 'none'}")
+
+    budgets = {
+        "import": args.budget_import_ms,
+        "first_response": args.budget_first_response_ms,
+    }
+    over = {
+        stage: budget for stage, budget in budgets.items() if median[stage] > budget
+    }
+
+    for stage, budget in budgets.items():
+        status = "OVER" if stage in over else "ok"
+        print(f"Budget {stage:<20}{budget:9.1f} ms  {status}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "meta": {
+                        "revision": git_revision(),
+                        "python": platform.python_version(),
+                        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                        "args": vars(args),
+                    },
+                    "modules": modules,
+                    "runs": runs,
+                    "median_ms": median,
+                    "budgets_ms": budgets,
+                },
+                f,
+                indent=2,
+            )
+
+    sys.exit(1 if over else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,4 +11,5 @@ setup(
     setup_requires=["pytest-runner", "flake8"],
     tests_require=["pytest"],
     license="MIT",
+    entry_points={"console_scripts": ["music-batch=src.batch:main"]},
 )
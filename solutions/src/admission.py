@@ -0,0 +1,132 @@
+import asyncio
+import concurrent.futures
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional
+
+# State of the request being handled: its deadline and the reasons its
+# response is degraded. The dictionary is shared with the tasks that the
+# request spawns, so they can mark it degraded too.
+_request: ContextVar[Optional[Dict]] = ContextVar("request", default=None)
+
+# Raised when waiting for a fetch takes longer than the deadline allows;
+# asyncio and concurrent.futures have their own classes before Python 3.11.
+DEADLINE_ERRORS = (
+    TimeoutError,
+    asyncio.TimeoutError,
+    concurrent.futures.TimeoutError,
+)
+
+
+class ConcurrencyLimit:
+    """ Limits the number of requests to an endpoint that are handled at once.
+    A request that finds all slots taken waits at most `max_wait` seconds
+    for one and is shed otherwise, so overload fails fast instead of
+    queueing without bound.
+    """
+
+    def __init__(self, limit: int, max_wait: float = 0.0):
+        """
+        :param limit: Maximum number of requests handled at once.
+        :param max_wait: Seconds a request waits for a free slot.
+        """
+        self.limit = limit
+        self.max_wait = max_wait
+        self._semaphore = asyncio.Semaphore(limit)
+
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = 0
+        self.degraded = 0
+
+    async def acquire(self) -> bool:
+        """ Takes a slot.
+
+        :return: Whether the request is admitted, False if it is shed.
+        """
+        if self._semaphore.locked() and self.max_wait <= 0:
+            self.shed += 1
+            return False
+
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.max_wait or None)
+        except asyncio.TimeoutError:
+            self.shed += 1
+            return False
+
+        self.in_flight += 1
+        self.admitted += 1
+
+        return True
+
+    def release(self):
+        """ Frees the slot of an admitted request. """
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def stats(self) -> Dict:
+        """ Returns the limit and the admission counters.
+
+        :return: Dictionary with the number of requests in flight, admitted,
+            shed and answered with degraded data.
+        """
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "degraded": self.degraded,
+        }
+
+
+@contextmanager
+def request_context(deadline: Optional[float] = None) -> Iterator[Dict]:
+    """ Sets the deadline of the request that is handled in this context.
+
+    :param deadline: Seconds the request may take, None for no deadline.
+    :return: State of the request, see `degraded`.
+    """
+    state = {
+        "deadline": time.monotonic() + deadline if deadline else None,
+        "degraded": [],
+    }
+    token = _request.set(state)
+
+    try:
+        yield state
+    finally:
+        _request.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """ Returns the seconds left until the deadline of the current request,
+    None when there is no deadline.
+    """
+    state = _request.get()
+
+    if state is None or state["deadline"] is None:
+        return None
+
+    return max(state["deadline"] - time.monotonic(), 0.0)
+
+
+def mark_degraded(reason: str):
+    """ Marks the response to the current request as degraded.
+
+    :param reason: Fixed code of why the response is degraded, e.g.
+        'tracks: spotify-unavailable'. It is sent in a header, so it must not
+        contain request input such as playlist ids.
+    """
+    state = _request.get()
+
+    if state is not None and reason not in state["degraded"]:
+        state["degraded"].append(reason)
+
+
+def degraded() -> List[str]:
+    """ Returns the reasons the response to the current request is degraded. """
+    state = _request.get()
+
+    return list(state["degraded"]) if state is not None else []
@@ -0,0 +1,204 @@
+import asyncio
+import copy
+import os
+import time
+
+from typing import Dict, List, Optional
+
+import httpx
+
+from spotipy.client import SpotifyException
+
+from src import metrics
+from src.rate_limit import RateLimiter
+
+
+class AsyncSpotify:
+    """ Asynchronous client for the Spotify Web API endpoints used by the
+    MusicModel. All requests share one pooled httpx connection pool, so many
+    concurrent requests can wait on Spotify without occupying a thread each.
+
+    Access tokens are taken from the spotipy auth manager, which keeps
+    handling the OAuth flow and the token cache. Requests are rate limited
+    and retried by a `RateLimiter`, which can be shared with the spotipy client.
+    """
+
+    prefix = "https://api.spotify.com/v1/"
+
+    def __init__(
+        self,
+        auth_manager,
+        max_connections: Optional[int] = None,
+        timeout: float = 10.0,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        limiter: Optional[RateLimiter] = None,
+    ):
+        """
+        :param auth_manager: Spotipy auth manager that provides access tokens.
+        :param max_connections: Size of the connection pool.
+        :param timeout: Timeout in seconds for a single request.
+        :param transport: Optional httpx transport, e.g. to serve a local stand-in.
+        :param limiter: Rate limiter for all requests, a new one by default.
+        """
+        if max_connections is None:
+            max_connections = int(os.environ.get("SPOTIFY_MAX_CONNECTIONS", 100))
+
+        self.auth_manager = auth_manager
+        self.limiter = limiter or RateLimiter()
+        self.client = httpx.AsyncClient(
+            base_url=self.prefix,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=timeout,
+            transport=transport,
+        )
+
+    def with_auth(self, auth_manager) -> "AsyncSpotify":
+        """ Returns a client that sends requests with the tokens of another
+        auth manager, sharing this client's connection pool and rate limiter.
+        Only this client should be closed.
+
+        :param auth_manager: Spotipy auth manager that provides access tokens.
+        :return: Client for the other identity.
+        """
+        client = copy.copy(self)
+        client.auth_manager = auth_manager
+
+        return client
+
+    async def _get(
+        self, endpoint: str, url: str, params: Optional[Dict] = None
+    ) -> Dict:
+        """ Sends an authorized GET request and returns the decoded response.
+        Rate limited, failed and timed out requests are retried by the limiter.
+
+        :param endpoint: Name of the endpoint, used as metric label.
+        :param url: Endpoint path relative to the API prefix, or a full url.
+        :param params: Query parameters.
+        :return: Decoded json response.
+        """
+        return await self.limiter.acall(lambda: self._send(endpoint, url, params))
+
+    async def _send(
+        self, endpoint: str, url: str, params: Optional[Dict] = None
+    ) -> Dict:
+        """ Sends a single request, see `_get`. """
+        metrics.SPOTIFY_CALLS.inc(endpoint=endpoint)
+
+        with metrics.timer(f"spotify_{endpoint}"):
+            response = await self.client.get(
+                url,
+                params=params,
+                headers={"Authorization": f"Bearer {await self._access_token()}"},
+            )
+
+        if response.status_code >= 400:
+            try:
+                msg = response.json()["error"]["message"]
+            except (ValueError, KeyError, TypeError):
+                msg = response.text
+
+            raise SpotifyException(
+                response.status_code,
+                -1,
+                f"{response.url}:\n {msg}",
+                headers=dict(response.headers),
+            )
+
+        return response.json()
+
+    async def _access_token(self) -> str:
+        """ Returns a valid access token. Only a missing or expired token is
+        refreshed, in a worker thread because spotipy refreshes synchronously.
+
+        :return: Access token.
+        """
+        token = self.auth_manager.cache_handler.get_cached_token()
+
+        if token and not self.auth_manager.is_token_expired(token):
+            return token["access_token"]
+
+        return await asyncio.get_running_loop().run_in_executor(
+            None, lambda: self.auth_manager.get_access_token(as_dict=False)
+        )
+
+    async def playlist(self, playlist_id: str) -> Dict:
+        """ Returns a playlist, including the first page of its tracks.
+
+        :param playlist_id: Spotify playlist id.
+        :return: Playlist object.
+        """
+        return await self._get("playlist", f"playlists/{playlist_id}")
+
+    async def playlist_items(
+        self, playlist_id: str, offset: int = 0, limit: int = 100
+    ) -> Dict:
+        """ Returns a page of the tracks of a playlist.
+
+        :param playlist_id: Spotify playlist id.
+        :param offset: Index of the first track to return.
+        :param limit: Number of tracks to return.
+        :return: Paging object with playlist tracks.
+        """
+        return await self._get(
+            "playlist_items",
+            f"playlists/{playlist_id}/tracks",
+            params={"offset": offset, "limit": limit},
+        )
+
+    async def current_user_top_tracks(
+        self, limit: int = 20, offset: int = 0, time_range: str = "medium_term"
+    ) -> Dict:
+        """ Returns the top tracks of the current user.
+
+        :param limit: Number of tracks to return.
+        :param offset: Index of the first track to return.
+        :param time_range: 'short_term', 'medium_term' or 'long_term'.
+        :return: Paging object with tracks.
+        """
+        return await self._get(
+            "current_user_top_tracks",
+            "me/top/tracks",
+            params={"time_range": time_range, "limit": limit, "offset": offset},
+        )
+
+    async def audio_features(self, track_ids: List[str]) -> List[Dict]:
+        """ Returns the audio features of the given tracks.
+
+        :param track_ids: List of Spotify track id's.
+        :return: List of audio feature objects.
+        """
+        results = await self._get(
+            "audio_features", "audio-features", params={"ids": ",".join(track_ids)}
+        )
+
+        return results["audio_features"]
+
+    async def aclose(self):
+        """ Closes the connection pool. """
+        await self.client.aclose()
+
+
+class TokenAuth:
+    """ Auth manager for an access token that the caller obtained itself,
+    e.g. the token of a user sent along with a request. The token is never
+    refreshed by the app; an expired token is rejected by Spotify with 401.
+    """
+
+    def __init__(self, access_token: str):
+        """
+        :param access_token: Spotify access token.
+        """
+        self.cache_handler = self
+        self.access_token = access_token
+
+    def get_cached_token(self) -> Dict:
+        return {"access_token": self.access_token, "expires_at": time.time() + 3600}
+
+    def is_token_expired(self, token: Dict) -> bool:
+        return False
+
+    def get_access_token(self, as_dict: bool = False) -> str:
+        return self.access_token
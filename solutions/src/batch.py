@@ -0,0 +1,320 @@
+"""
+Offline batch scoring of playlists against the top tracks of the user.
+
+Reads a file of (playlist id, term) queries, as CSV with a header or as
+JSON lines, and writes the prediction for every query to CSV or JSON lines
+as soon as it is computed:
+
+    music-batch queries.csv --output predictions.jsonl
+    python -m src.batch queries.jsonl --top 5 --workers 4 --offline
+
+Queries are grouped per playlist and scored in a process pool, so every
+worker fits the model of a playlist once and scores all its terms with a
+single neighbour search. The workers only read the local feature store.
+Unless `--offline` is given, playlists and top tracks that are missing or
+changed are ingested from Spotify first, in this process. Playlists that
+are not in the store fail with an error row; the playlist id 'default'
+scores the bundled tracks. Top tracks fall back to the bundled ones, like
+in the app.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, TextIO, Tuple
+
+from src import feature_store
+from src.class_definitions import Term
+from src.spotify import MusicModel
+
+logger = logging.getLogger(__name__)
+
+FIELDS = [
+    "playlist_id",
+    "term",
+    "rank",
+    "favourite_song",
+    "most_similar_song",
+    "distance",
+    "error",
+]
+
+# Model of the worker process, see `_init_worker`.
+_music_model: Optional[MusicModel] = None
+
+
+def read_queries(file: str) -> List[Tuple[str, str]]:
+    """ Returns the distinct (playlist id, term) queries in the given file,
+    in order of appearance.
+
+    :param file: CSV file with a playlist_id and term column, or JSON lines
+        file with objects with these keys, '-' for stdin. The term defaults
+        to short_term.
+    :return: List of (playlist id, term) pairs.
+    """
+    f = sys.stdin if file == "-" else open(file, newline="")
+
+    try:
+        lines = [line for line in f if line.strip()]
+
+        if lines and lines[0].lstrip().startswith("{"):
+            rows = (json.loads(line) for line in lines)
+        else:
+            rows = csv.DictReader(lines)
+
+        queries = [
+            (row["playlist_id"].strip(), (row.get("term") or "short_term").strip())
+            for row in rows
+        ]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+    return list(dict.fromkeys(queries))
+
+
+def ingest(music_model: MusicModel, queries: List[Tuple[str, str]]) -> Dict[str, str]:
+    """ Stores the playlists and top tracks of the given queries that are
+    missing in the feature store and refreshes the ones that changed.
+
+    :param music_model: Authenticated model.
+    :param queries: List of (playlist id, term) pairs.
+    :return: Error message per playlist id or term that could not be ingested.
+    """
+    entries = [
+        ("user_tracks", term) for term in dict.fromkeys(term for _, term in queries)
+    ]
+    entries += [
+        ("tracks", playlist_id)
+        for playlist_id in dict.fromkeys(p for p, _ in queries)
+        if playlist_id != "default"
+    ]
+
+    def ingest_entry(key: tuple):
+        table, name = key
+        stored = feature_store.exists(
+            os.path.join(music_model.store_dir, f"{table}_{name}")
+        )
+
+        if table == "tracks" and stored:
+            music_model.refresh_tracks(name)
+        elif table == "tracks":
+            music_model.read_tracks(name)
+        elif stored:
+            music_model.refresh_user_tracks(name)
+        else:
+            music_model.read_user_tracks(name)
+
+    # The entries get their own pool: fetching tracks waits for audio
+    # features fetched on `music_model.executor`, which would deadlock once
+    # every worker of that pool ran an entry.
+    errors = {}
+
+    with ThreadPoolExecutor(max_workers=music_model.max_workers) as pool:
+        futures = {key: pool.submit(ingest_entry, key) for key in entries}
+
+        for (table, name), future in futures.items():
+            try:
+                future.result()
+            except Exception as error:
+                logger.warning("Ingesting %s %s failed: %s", table, name, error)
+                errors[name] = f"Ingest failed: {error}"
+
+    return errors
+
+
+def _init_worker():
+    global _music_model
+    _music_model = MusicModel(lazy=True)
+
+
+def score(playlist_id: str, terms: List[str], top: Optional[int]) -> List[Dict]:
+    """ Returns the result rows of all terms for one playlist. Runs in a
+    worker process and only reads the local feature store.
+
+    :param playlist_id: Spotify playlist id, or 'default' for the bundled tracks.
+    :param terms: Terms to score the playlist for.
+    :param top: Number of ranked matches per term, None for the single best match.
+    :return: List of dictionaries with the keys in `FIELDS`.
+    """
+    music_model = _music_model
+    path = os.path.join(music_model.store_dir, f"tracks_{playlist_id}")
+
+    if playlist_id != "default" and not feature_store.exists(path):
+        return [
+            {"playlist_id": playlist_id, "term": term, "error": "Playlist not stored"}
+            for term in terms
+        ]
+
+    rows = []
+
+    try:
+        tracks = music_model.read_tracks(playlist_id)
+        user_tracks = {term: music_model.read_user_tracks(term) for term in terms}
+
+        if top is None:
+            predictions = music_model.match_batch(
+                [(playlist_id, term) for term in terms],
+                {playlist_id: tracks},
+                user_tracks,
+            )
+            for term, prediction in zip(terms, predictions):
+                rows.append({"playlist_id": playlist_id, "term": term, **prediction})
+        else:
+            for term in terms:
+                for match in music_model.match_top(
+                    playlist_id, tracks, user_tracks[term], top
+                ):
+                    rows.append({"playlist_id": playlist_id, "term": term, **match})
+    except Exception as error:
+        logger.exception("Scoring playlist %s failed", playlist_id)
+        rows = [
+            {"playlist_id": playlist_id, "term": term, "error": str(error)}
+            for term in terms
+        ]
+
+    return rows
+
+
+class ResultWriter:
+    """ Writes result rows to a CSV or JSON lines file, flushing every row so
+    the results can be followed while the batch runs.
+    """
+
+    def __init__(self, f: TextIO, output_format: str):
+        """
+        :param f: File to write to.
+        :param output_format: 'csv' or 'jsonl'.
+        """
+        self.f = f
+        self.output_format = output_format
+        self.rows = 0
+        self.errors = 0
+
+        if output_format == "csv":
+            self.writer = csv.DictWriter(f, fieldnames=FIELDS)
+            self.writer.writeheader()
+
+    def write(self, row: Dict):
+        """ Writes one result row. """
+        if self.output_format == "csv":
+            self.writer.writerow(row)
+        else:
+            self.f.write(json.dumps(row) + "\n")
+
+        self.f.flush()
+        self.rows += 1
+        self.errors += "error" in row
+
+
+def run(
+    queries: List[Tuple[str, str]],
+    writer: ResultWriter,
+    workers: int,
+    top: Optional[int] = None,
+    errors: Optional[Dict[str, str]] = None,
+) -> None:
+    """ Scores all queries in a process pool and writes the result rows in
+    the order in which the playlists finish.
+
+    :param queries: List of (playlist id, term) pairs.
+    :param writer: Writer of the result rows.
+    :param workers: Number of worker processes.
+    :param top: Number of ranked matches per query, None for the single best match.
+    :param errors: Error message per playlist id or term that is not scored.
+    """
+    errors = errors or {}
+    terms_per_playlist = {}
+
+    for playlist_id, term in queries:
+        error = errors.get(playlist_id) or errors.get(term)
+
+        if term not in Term.__members__:
+            error = f"Unknown term {term!r}"
+
+        if error:
+            writer.write({"playlist_id": playlist_id, "term": term, "error": error})
+        else:
+            terms_per_playlist.setdefault(playlist_id, []).append(term)
+
+    if not terms_per_playlist:
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(terms_per_playlist)), initializer=_init_worker
+    ) as pool:
+        futures = [
+            pool.submit(score, playlist_id, terms, top)
+            for playlist_id, terms in terms_per_playlist.items()
+        ]
+
+        for future in as_completed(futures):
+            for row in future.result():
+                writer.write(row)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "queries", help="CSV or JSON lines file with queries, - for stdin."
+    )
+    parser.add_argument(
+        "-o", "--output", default="-", help="Result file, - for stdout."
+    )
+    parser.add_argument(
+        "--format",
+        choices=["csv", "jsonl"],
+        help="Format of the results, by default from the output file extension.",
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--top", type=int, help="Write the k best matches per query, ranked."
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Only use the local feature store, do not call Spotify.",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    start = time.perf_counter()
+    queries = read_queries(args.queries)
+    errors = {}
+
+    if not args.offline:
+        music_model = MusicModel()
+        logger.info(music_model.auth_msg)
+
+        if music_model.spt is not None:
+            errors = ingest(music_model, queries)
+
+    output_format = args.format or ("csv" if args.output.endswith(".csv") else "jsonl")
+    f = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+
+    try:
+        writer = ResultWriter(f, output_format)
+        run(queries, writer, args.workers, args.top, errors)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    logger.info(
+        "Scored %d queries into %d rows, %d errors, in %.1f s",
+        len(queries),
+        writer.rows,
+        writer.errors,
+        time.perf_counter() - start,
+    )
+
+    return 1 if writer.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,226 @@
+import asyncio
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+
+class LRUCache:
+    """ Thread-safe in-memory cache with a size budget, a time-to-live and
+    least-recently-used eviction.
+
+    Every entry carries a version (e.g. the mtime of the file it was read
+    from); a lookup with a different version counts as a miss.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: Optional[float] = None,
+        sizeof: Callable[[Any], int] = lambda value: 1,
+    ):
+        """
+        :param max_size: Total size budget, measured with `sizeof`.
+        :param ttl: Seconds an entry stays valid, None to never expire.
+        :param sizeof: Returns the size of a cached value.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof
+
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, version: Any = None) -> Optional[Any]:
+        """ Returns the cached value for the key, or None when it is missing,
+        expired or stored under another version.
+
+        :param key: Cache key.
+        :param version: Expected version of the entry.
+        :return: Cached value or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                value, entry_version, expires, size = entry
+
+                if entry_version == version and (
+                    expires is None or expires > time.monotonic()
+                ):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                self._remove(key)
+
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value: Any, version: Any = None):
+        """ Stores a value and evicts the least recently used entries until
+        the cache fits its size budget again.
+
+        :param key: Cache key.
+        :param value: Value to cache.
+        :param version: Version of the value.
+        """
+        size = self.sizeof(value)
+
+        if size > self.max_size:
+            return
+
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (value, version, expires, size)
+            self._size += size
+
+            while self._size > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        """ Drops the entry for the given key, if any.
+
+        :param key: Cache key.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """ Drops the entries whose key matches the predicate.
+
+        :param predicate: Returns whether the entry with the given key is dropped.
+        :return: Number of dropped entries.
+        """
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+
+            for key in keys:
+                self._remove(key)
+
+            return len(keys)
+
+    def entries(self) -> List[Tuple[Hashable, Any, int]]:
+        """ Returns the key, value and size of every entry, least recently used
+        first. Expired entries are included and nothing counts as a lookup.
+        """
+        with self._lock:
+            return [
+                (key, value, size)
+                for key, (value, _, _, size) in self._entries.items()
+            ]
+
+    def clear(self):
+        """ Drops all entries. The counters are kept. """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> Dict:
+        """ Returns the hit/miss counters and the current fill level.
+
+        :return: Dictionary with cache statistics.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+
+            return {
+                "entries": len(self._entries),
+                "size": self._size,
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _remove(self, key: Hashable):
+        _, _, _, size = self._entries.pop(key)
+        self._size -= size
+
+
+class SingleFlight:
+    """ Coalesces concurrent calls per key: while a call for a key is running,
+    other threads asking for the same key wait for it and share its result
+    instead of starting their own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """ Runs `fn` unless a call for the key is already in flight, in which
+        case that call's result is returned (or its exception raised).
+
+        :param key: Key that identifies the call.
+        :param fn: Function to run.
+        :return: Result of the call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self._calls[key] = {"done": threading.Event()}
+
+        if not leader:
+            call["done"].wait()
+
+            if "error" in call:
+                raise call["error"]
+
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except BaseException as error:
+            call["error"] = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+            call["done"].set()
+
+
+class AsyncSingleFlight:
+    """ Asyncio variant of `SingleFlight`: concurrent coroutines asking for the
+    same key await one shared task.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]) -> Any:
+        """ Awaits `fn()` unless a call for the key is already in flight, in
+        which case that call's result is returned (or its exception raised).
+        Cancelling one waiter does not cancel the shared call.
+
+        :param key: Key that identifies the call.
+        :param fn: Returns the coroutine to run.
+        :return: Result of the call.
+        """
+        task = self._tasks.get(key)
+
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+
+        return await asyncio.shield(task)
@@ -0,0 +1,207 @@
+import hashlib
+import threading
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+# Value ranges of the Spotify audio features. Scaling with fixed ranges keeps
+# distances comparable across playlists and lets new playlists be added
+# without rescaling the ones already indexed.
+FEATURE_RANGES = {
+    "danceability": (0.0, 1.0),
+    "energy": (0.0, 1.0),
+    "loudness": (-60.0, 0.0),
+    "speechiness": (0.0, 1.0),
+    "acousticness": (0.0, 1.0),
+    "instrumentalness": (0.0, 1.0),
+    "liveness": (0.0, 1.0),
+    "valence": (0.0, 1.0),
+    "tempo": (0.0, 250.0),
+}
+
+
+class CatalogIndex:
+    """ Nearest neighbour index over the tracks of all cached playlists.
+
+    Indexed tracks live in a KD-tree. Playlists added after the tree was
+    built are kept in a small pending buffer that is searched brute force,
+    and folded into the tree once it grows past `rebuild_threshold` rows.
+    """
+
+    def __init__(self, features: List[str], rebuild_threshold: int = 5000):
+        """
+        :param features: Names of the feature columns to index.
+        :param rebuild_threshold: Number of pending rows that triggers a rebuild.
+        """
+        self.features = features
+        self.rebuild_threshold = rebuild_threshold
+
+        self._low = np.array([FEATURE_RANGES[f][0] for f in features])
+        self._range = np.array(
+            [FEATURE_RANGES[f][1] - FEATURE_RANGES[f][0] for f in features]
+        )
+
+        self._lock = threading.Lock()
+        self._playlists = {}
+        self._tree = None
+        self._indexed_labels = []
+        self._indexed_playlists = []
+        self._pending = []
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(labels) for _, _, labels in self._playlists.values())
+
+    def scale(self, X: pd.DataFrame) -> np.ndarray:
+        """ Scales features to [0, 1] using the fixed feature ranges.
+
+        :param X: Dataframe containing the feature columns.
+        :return: Scaled feature matrix.
+        """
+        return (X[self.features].to_numpy(dtype=np.float64) - self._low) / self._range
+
+    def add(self, playlist_id: str, tracks: pd.DataFrame, version=None):
+        """ Adds the tracks of a playlist, replacing an older version of it.
+
+        :param playlist_id: Spotify playlist id.
+        :param tracks: Dataframe containing tracks from the playlist.
+        :param version: Version of the tracks; adding the same version again is a no-op.
+        """
+        with self._lock:
+            current = self._playlists.get(playlist_id)
+
+            if current is not None and current[0] == version:
+                return
+
+            labels = [
+                f"{name} - {artists}"
+                for name, artists in zip(tracks["name"], tracks["artists"])
+            ]
+            matrix = self.scale(tracks)
+            self._playlists[playlist_id] = (version, matrix, labels)
+
+            self._pending.extend(
+                (row, label, playlist_id) for row, label in zip(matrix, labels)
+            )
+
+            # A replaced playlist may still be in the tree or the pending buffer.
+            if current is not None or len(self._pending) >= self.rebuild_threshold:
+                self._rebuild()
+
+    def contains(self, playlist_id: str, version=None) -> bool:
+        """ Returns whether the given version of a playlist is indexed. """
+        with self._lock:
+            current = self._playlists.get(playlist_id)
+
+            return current is not None and current[0] == version
+
+    def query(
+        self, X: pd.DataFrame, k: int = 10, exclude: Optional[List[str]] = None
+    ) -> List[Tuple[int, str, str, float]]:
+        """ Returns the k closest (query track, catalog track) pairs. Every
+        catalog track is returned at most once, also when it is part of
+        several playlists.
+
+        :param X: Dataframe containing the query tracks.
+        :param k: Number of pairs to return.
+        :param exclude: Labels of catalog tracks to leave out, e.g. the query tracks.
+        :return: List of (query row, catalog track label, playlist id, distance),
+            ordered by distance.
+        """
+        exclude = set(exclude or [])
+        queries = self.scale(X)
+
+        with self._lock:
+            # Duplicates and excluded tracks are dropped afterwards, so fetch
+            # more candidates than needed.
+            n = k * 4 + len(exclude)
+            candidates = []
+
+            if self._tree is not None:
+                n_tree = min(n, len(self._indexed_labels))
+                distance, indices = self._tree.query(queries, k=n_tree)
+                candidates.extend(
+                    (d, q, self._indexed_labels[i], self._indexed_playlists[i])
+                    for q, (row_d, row_i) in enumerate(zip(distance, indices))
+                    for d, i in zip(row_d, row_i)
+                )
+
+            if self._pending:
+                matrix = np.stack([row for row, _, _ in self._pending])
+                distance = np.sqrt(
+                    np.maximum(
+                        (queries ** 2).sum(axis=1)[:, None]
+                        + (matrix ** 2).sum(axis=1)[None, :]
+                        - 2 * queries @ matrix.T,
+                        0,
+                    )
+                )
+                n_pending = min(n, len(self._pending))
+                indices = np.argpartition(distance, n_pending - 1, axis=1)[
+                    :, :n_pending
+                ]
+                candidates.extend(
+                    (distance[q, i], q, self._pending[i][1], self._pending[i][2])
+                    for q in range(len(queries))
+                    for i in indices[q]
+                )
+
+        results, seen = [], set()
+        for d, q, label, playlist_id in sorted(candidates, key=lambda c: c[0]):
+            if label in seen or label in exclude:
+                continue
+
+            seen.add(label)
+            results.append((q, label, playlist_id, float(d)))
+
+            if len(results) == k:
+                break
+
+        return results
+
+    def version(self) -> str:
+        """ Returns a hash of the indexed playlists and their versions, which
+        changes whenever a playlist is added or replaced.
+        """
+        with self._lock:
+            versions = sorted(
+                (playlist_id, str(version))
+                for playlist_id, (version, _, _) in self._playlists.items()
+            )
+
+        return hashlib.sha1(repr(versions).encode()).hexdigest()
+
+    def stats(self) -> Dict:
+        """ Returns the size of the index.
+
+        :return: Dictionary with the number of playlists, indexed and pending tracks.
+        """
+        with self._lock:
+            return {
+                "playlists": len(self._playlists),
+                "indexed_tracks": len(self._indexed_labels),
+                "pending_tracks": len(self._pending),
+            }
+
+    def _rebuild(self):
+        """ Builds the KD-tree over all playlists and empties the pending buffer.
+        Must be called with the lock held.
+        """
+        self._indexed_labels = []
+        self._indexed_playlists = []
+        matrices = []
+
+        for playlist_id, (_, matrix, labels) in self._playlists.items():
+            matrices.append(matrix)
+            self._indexed_labels.extend(labels)
+            self._indexed_playlists.extend([playlist_id] * len(labels))
+
+        # Imported here, since sklearn takes long to import and the index is
+        # only built once playlists are added.
+        from sklearn.neighbors import KDTree
+
+        self._tree = KDTree(np.concatenate(matrices)) if self._indexed_labels else None
+        self._pending = []
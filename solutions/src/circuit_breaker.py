@@ -0,0 +1,99 @@
+import threading
+import time
+
+from typing import Dict
+
+import httpx
+import requests
+
+from spotipy.client import SpotifyException
+
+from src.rate_limit import RETRY_STATUSES
+
+
+def upstream_failure(error: Exception) -> bool:
+    """ Returns whether an error means that the Spotify API is unavailable,
+    as opposed to e.g. an unknown playlist id.
+    """
+    if isinstance(error, SpotifyException):
+        return error.http_status in RETRY_STATUSES
+
+    return isinstance(
+        error, (requests.ConnectionError, requests.Timeout, httpx.TransportError)
+    )
+
+
+class CircuitBreaker:
+    """ Stops fetching from the Spotify API while it is failing.
+
+    The breaker opens after `failure_threshold` failed fetches in a row.
+    While it is open no fetches are made, and after `reset_timeout` seconds
+    a single trial fetch is let through (half open): if it succeeds the
+    breaker closes, otherwise it stays open for another `reset_timeout`.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        :param failure_threshold: Number of failures in a row that opens the breaker.
+        :param reset_timeout: Seconds until a trial fetch is made.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        """ Returns whether a fetch may be made. Once the reset timeout has
+        passed, the first caller gets to make the trial fetch.
+        """
+        with self._lock:
+            if self.state == "closed":
+                return True
+
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._opened_at = time.monotonic()
+                return True
+
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        """ Records a fetch that Spotify answered, which closes the breaker. """
+        with self._lock:
+            self.state = "closed"
+            self._failures = 0
+
+    def record_failure(self):
+        """ Records a failed or timed out fetch, which opens the breaker after
+        `failure_threshold` failures in a row or a failed trial fetch.
+        """
+        with self._lock:
+            self._failures += 1
+
+            if self.state == "half_open" or (
+                self.state == "closed" and self._failures >= self.failure_threshold
+            ):
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                self.opened += 1
+
+    def stats(self) -> Dict:
+        """ Returns the state of the breaker and its counters.
+
+        :return: Dictionary with the state, the number of failures in a row,
+            how often the breaker opened and how many fetches it rejected.
+        """
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self._failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
@@ -34,3 +34,45 @@ class PredOut(BaseModel):
                 "distance": 0.15,
             }
         }
+
+
+class RankedPredOut(PredOut):
+    rank: int
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "rank": 1,
+                "favourite_song": "Always Remember Us This Way - Lady Gaga",
+                "most_similar_song": "De Diepte - S10",
+                "distance": 0.15,
+            }
+        }
+
+
+class CatalogPredOut(RankedPredOut):
+    playlist_id: str
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "rank": 1,
+                "favourite_song": "Always Remember Us This Way - Lady Gaga",
+                "most_similar_song": "De Diepte - S10",
+                "playlist_id": "37i9dQZF1DXb5BKLTO7ULa",
+                "distance": 0.15,
+            }
+        }
+
+
+class PredIn(BaseModel):
+    term: Term = Term.short_term
+    playlist_id: str = "37i9dQZF1DXb5BKLTO7ULa"
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "term": "short_term",
+                "playlist_id": "37i9dQZF1DXb5BKLTO7ULa",
+            }
+        }
@@ -0,0 +1,120 @@
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+
+class NumpyNN:
+    """ Min-max scaling plus brute force nearest neighbour search in NumPy.
+
+    Gives the same results as the `MinMaxScaler` and `NearestNeighbors`
+    pipeline of `MusicModel.fit_model`. It skips sklearn's input validation
+    and per-call setup, which dominate the run time for playlists of a few
+    hundred tracks. All query tracks are compared with all fitted tracks in
+    a single distance matrix, so memory and time grow with the product of
+    both sizes. Large playlists are better served by a tree.
+    """
+
+    def __init__(self, features):
+        """
+        :param features: Names of the feature columns.
+        """
+        self.features = features
+
+    def fit(self, X: pd.DataFrame) -> "NumpyNN":
+        """ Fits the scaler on the given tracks and stores the scaled tracks.
+
+        :param X: Dataframe containing the feature columns.
+        :return: The fitted engine.
+        """
+        values = X[self.features].to_numpy(dtype=np.float64)
+
+        return self.set_params(
+            np.nanmin(values, axis=0), np.nanmax(values, axis=0), values
+        )
+
+    def set_params(
+        self,
+        data_min: np.ndarray,
+        data_max: np.ndarray,
+        values: np.ndarray = None,
+        scaled: np.ndarray = None,
+    ) -> "NumpyNN":
+        """ Sets the scaler parameters and the fitted tracks, given either
+        unscaled or already scaled.
+
+        :param data_min: Minimum of every feature.
+        :param data_max: Maximum of every feature.
+        :param values: Unscaled feature matrix of the fitted tracks.
+        :param scaled: Scaled feature matrix of the fitted tracks.
+        :return: The fitted engine.
+        """
+        self.data_min_ = np.asarray(data_min, dtype=np.float64)
+        self.data_max_ = np.asarray(data_max, dtype=np.float64)
+
+        # Same as MinMaxScaler, which leaves constant features unscaled.
+        data_range = self.data_max_ - self.data_min_
+        data_range[data_range < 10 * np.finfo(np.float64).eps] = 1.0
+        self.scale_ = 1.0 / data_range
+        self.min_ = -self.data_min_ * self.scale_
+
+        self.fit_X_ = self._scale(values) if scaled is None else scaled
+        self.sq_norms_ = np.einsum("ij,ij->i", self.fit_X_, self.fit_X_)
+
+        return self
+
+    def transform(self, X: pd.DataFrame) -> np.ndarray:
+        """ Returns the scaled feature matrix of the given tracks. """
+        return self._scale(X[self.features].to_numpy(dtype=np.float64))
+
+    def kneighbors(
+        self, X: pd.DataFrame, n_neighbors: int = 1
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """ Returns the closest fitted tracks for every given track.
+
+        :param X: Dataframe containing the feature columns.
+        :param n_neighbors: Number of neighbours per track.
+        :return: Distances and positions of the neighbours, closest first,
+            both of shape (len(X), n_neighbors).
+        """
+        queries = self.transform(X)
+
+        # Squared distances via |a|^2 + |b|^2 - 2ab, which is one matrix
+        # product, only to select the neighbours. Their distances are
+        # computed exactly afterwards.
+        distance = (
+            np.einsum("ij,ij->i", queries, queries)[:, None]
+            + self.sq_norms_[None, :]
+            - 2 * queries @ self.fit_X_.T
+        )
+
+        if n_neighbors == 1:
+            indices = distance.argmin(axis=1)[:, None]
+        else:
+            indices = np.argpartition(distance, n_neighbors - 1, axis=1)[
+                :, :n_neighbors
+            ]
+
+        exact = np.sqrt(
+            ((queries[:, None, :] - self.fit_X_[indices]) ** 2).sum(axis=2)
+        )
+        order = np.argsort(exact, axis=1, kind="stable")
+
+        return (
+            np.take_along_axis(exact, order, axis=1),
+            np.take_along_axis(indices, order, axis=1),
+        )
+
+    def predict(self, X: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+        """ Returns the closest fitted track for every given track, like the
+        sklearn pipeline does.
+        """
+        return self.kneighbors(X, n_neighbors=1)
+
+    @property
+    def nbytes(self) -> int:
+        """ Returns the approximate memory used by the fitted engine. """
+        return self.fit_X_.nbytes + self.sq_norms_.nbytes + 4 * self.scale_.nbytes
+
+    def _scale(self, values: np.ndarray) -> np.ndarray:
+        return values * self.scale_ + self.min_
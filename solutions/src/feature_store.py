@@ -0,0 +1,296 @@
+"""
+Binary on-disk store for track tables.
+
+A table stored under `path` consists of two files:
+
+* `{path}-{token}.npy`: the feature matrix as a C-contiguous float32 array,
+  loaded with memory mapping so reading it does not parse or copy anything.
+* `{path}.json`: the feature names, the other (text) columns, the
+  `DataFrame.attrs` of the table and the name of the current `.npy` file.
+
+The json file is written last and replaced atomically, so it acts as the
+commit point: readers either see the previous table or the new one.
+
+Since the matrices are memory mapped, processes that read the same store
+share one copy of them in the page cache. Pointing the store at a tmpfs
+such as /dev/shm keeps them in shared memory altogether.
+
+Loaded tables use the compact representation of `compact`: float32
+features in a single block and the name and artists as categoricals.
+"""
+
+import json
+import os
+import tempfile
+import uuid
+
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import numpy as np
+import pandas as pd
+
+from src import metrics
+
+# float32 keeps the audio features, which Spotify reports with at most six
+# significant digits, and halves the memory of the float64 default.
+FEATURE_DTYPE = np.float32
+
+# Text columns with repeated values, e.g. artists with several songs.
+CATEGORY_COLUMNS = ("name", "artists")
+
+
+def exists(path: str) -> bool:
+    """ Returns whether a table is stored under the given path.
+
+    :param path: Path of the table, without extension.
+    :return: Whether the table exists.
+    """
+    return os.path.isfile(f"{path}.json")
+
+
+def save(path: str, tracks: pd.DataFrame, features: List[str]):
+    """ Stores a track table.
+
+    :param path: Path of the table, without extension.
+    :param tracks: Dataframe containing the tracks.
+    :param features: Names of the numeric feature columns.
+    """
+    columns = {
+        column: tracks[column].tolist() for column in _text_columns(tracks, features)
+    }
+
+    save_matrix(
+        path,
+        tracks[features].to_numpy(dtype=FEATURE_DTYPE),
+        {"features": features, "columns": columns, "attrs": dict(tracks.attrs)},
+        dtype=FEATURE_DTYPE,
+    )
+
+
+def save_matrix(path: str, matrix: np.ndarray, meta: Dict, dtype=np.float64):
+    """ Stores a matrix together with json serializable metadata.
+
+    :param path: Path of the matrix, without extension.
+    :param matrix: Two dimensional array.
+    :param meta: Metadata stored in the json file.
+    :param dtype: Data type of the stored matrix.
+    """
+    directory = os.path.dirname(path) or "."
+    features_file = f"{os.path.basename(path)}-{uuid.uuid4().hex}.npy"
+    old_file = _features_file(path)
+
+    _atomic_write(
+        os.path.join(directory, features_file),
+        lambda f: np.save(f, np.ascontiguousarray(matrix, dtype=dtype)),
+        "wb",
+    )
+    _atomic_write(
+        f"{path}.json",
+        lambda f: json.dump({**meta, "features_file": features_file}, f),
+        "w",
+    )
+
+    # Only the file of the table that was replaced is removed: another writer
+    # may have committed its own file in the meantime.
+    if old_file is not None:
+        try:
+            os.remove(os.path.join(directory, old_file))
+        except FileNotFoundError:
+            pass
+
+
+def load(path: str) -> pd.DataFrame:
+    """ Loads a track table. The feature columns are backed by a read-only
+    memory map of the `.npy` file.
+
+    :param path: Path of the table, without extension.
+    :return: Dataframe containing the tracks.
+    """
+    try:
+        return _load(path)
+    except FileNotFoundError:
+        # The table was replaced between reading the json and opening the
+        # features file; the json now points at the new one.
+        return _load(path)
+
+
+def load_attrs(path: str) -> Dict:
+    """ Returns the `DataFrame.attrs` of a stored table, e.g. the playlist
+    snapshot id, without loading its features.
+
+    :param path: Path of the table, without extension.
+    :return: Dictionary with the attrs, empty if nothing is stored.
+    """
+    try:
+        with open(f"{path}.json", "rb") as f:
+            return json.load(f).get("attrs", {})
+    except FileNotFoundError:
+        return {}
+
+
+def load_matrix(path: str) -> Tuple[np.ndarray, Dict]:
+    """ Loads a matrix stored with `save_matrix`.
+
+    :param path: Path of the matrix, without extension.
+    :return: Read-only memory map of the matrix and its metadata.
+    """
+    try:
+        return _load_matrix(path)
+    except FileNotFoundError:
+        return _load_matrix(path)
+
+
+def compact(tracks: pd.DataFrame, features: List[str]) -> pd.DataFrame:
+    """ Returns tracks in the compact in-memory representation: the features
+    as one C-contiguous float32 block, the name and artists as categoricals
+    and without leftover index columns of a csv round trip.
+
+    :param tracks: Dataframe containing the tracks.
+    :param features: Names of the numeric feature columns.
+    :return: Compact dataframe with a range index.
+    """
+    columns = {
+        column: tracks[column].tolist() for column in _text_columns(tracks, features)
+    }
+
+    return _table(
+        np.ascontiguousarray(tracks[features].to_numpy(dtype=FEATURE_DTYPE)),
+        features,
+        columns,
+        tracks.attrs,
+    )
+
+
+def migrate(csv_file: str, path: str, features: List[str]) -> bool:
+    """ Converts a csv file written by an earlier version into the binary store.
+    Concurrent callers, also in other processes, migrate it only once.
+
+    :param csv_file: Path of the csv file.
+    :param path: Path of the table, without extension.
+    :param features: Names of the numeric feature columns.
+    :return: Whether a csv file was migrated.
+    """
+    if not os.path.isfile(csv_file):
+        return False
+
+    with FileLock(path):
+        if not exists(path):
+            save(path, pd.read_csv(csv_file), features)
+
+    return True
+
+
+class FileLock:
+    """ Exclusive lock on a stored table that is held across processes, so
+    only one worker fills it. Without fcntl (on Windows) it does nothing.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: Path of the table, without extension.
+        """
+        self.file = f"{path}.lock"
+        self._f = None
+
+    def acquire(self):
+        if fcntl is not None:
+            self._f = open(self.file, "a")
+            fcntl.flock(self._f, fcntl.LOCK_EX)
+
+    def release(self):
+        if self._f is not None:
+            fcntl.flock(self._f, fcntl.LOCK_UN)
+            self._f.close()
+            self._f = None
+
+    def __enter__(self):
+        self.acquire()
+
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _load(path: str) -> pd.DataFrame:
+    features, meta = _load_matrix(path)
+
+    # Tables written by earlier versions hold float64 features.
+    if features.dtype != FEATURE_DTYPE:
+        features = features.astype(FEATURE_DTYPE)
+
+    return _table(features, meta["features"], meta["columns"], meta.get("attrs", {}))
+
+
+def _table(
+    features: np.ndarray, feature_names: List[str], columns: Dict, attrs: Dict
+) -> pd.DataFrame:
+    """ Builds a compact track table around the given feature matrix, without
+    copying it.
+    """
+    tracks = pd.DataFrame(features, columns=feature_names, copy=False)
+
+    for column, values in columns.items():
+        tracks[column] = (
+            pd.Categorical(values) if column in CATEGORY_COLUMNS else values
+        )
+
+    tracks.attrs.update(attrs)
+
+    return tracks
+
+
+def _text_columns(tracks: pd.DataFrame, features: List[str]) -> List[str]:
+    """ Returns the columns other than the features, without leftover index
+    columns such as 'Unnamed: 0'.
+    """
+    return [
+        column
+        for column in tracks.columns
+        if column not in features and not str(column).startswith("Unnamed")
+    ]
+
+
+def _features_file(path: str) -> Optional[str]:
+    """ Returns the name of the `.npy` file of the stored table, None if
+    nothing is stored.
+    """
+    try:
+        with open(f"{path}.json", "rb") as f:
+            return json.load(f).get("features_file")
+    except FileNotFoundError:
+        return None
+
+
+def _load_matrix(path: str) -> Tuple[np.ndarray, Dict]:
+    with open(f"{path}.json", "rb") as f:
+        raw = f.read()
+        meta = json.loads(raw)
+
+    matrix = np.load(
+        os.path.join(os.path.dirname(path), meta["features_file"]), mmap_mode="r"
+    )
+    metrics.BYTES_READ.inc(len(raw) + matrix.nbytes)
+
+    return matrix, meta
+
+
+def _atomic_write(file: str, write, mode: str):
+    """ Writes a file through a temporary file in the same directory that is
+    renamed into place, so readers never see a partially written file.
+    """
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(file) or ".", suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
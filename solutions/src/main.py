@@ -1,12 +1,43 @@
-from fastapi import FastAPI, Query, HTTPException
-from fastapi.responses import HTMLResponse
+import asyncio
+import logging
+import os
+import time
 
-from src.class_definitions import Term, Song, PredOut
+from fastapi import Depends, FastAPI, Query, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    ORJSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+
+from src.class_definitions import (
+    Term,
+    Song,
+    PredOut,
+    PredIn,
+    RankedPredOut,
+    CatalogPredOut,
+)
+from src.responses import (
+    SongsResponse,
+    cache_headers,
+    iter_songs_ndjson,
+    not_modified,
+)
 from src.spotify import MusicModel
+from src.tenants import Session, Tenants
+from src import admission, metrics
 
+from pydantic import conlist
 from spotipy.client import SpotifyException
 
-from typing import List
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
 
 description = """
 Spotify: receive Spotify songs based on your very own personal music taste
@@ -27,13 +58,320 @@ tags_metadata = [
         "description": "Predicts which song from the given playlist is \
             most similar to one of your top songs.",
     },
+    {
+        "name": "recommend",
+        "description": "Recommends the songs across all cached playlists that are \
+            most similar to your top songs.",
+    },
+    {
+        "name": "session",
+        "description": "Ends your session. Send your Spotify access token as \
+            'Authorization: Bearer <token>' to get results for your own top songs.",
+    },
+    {
+        "name": "health",
+        "description": "Liveness and readiness probes.",
+    },
+    {
+        "name": "metrics",
+        "description": "Request and per-stage latency metrics in Prometheus format.",
+    },
+    {
+        "name": "cache",
+        "description": "Shows cache statistics and playlist ingest timings.",
+    },
 ]
 
 
-music_model = MusicModel()
+music_model = MusicModel(lazy=True)
 
 app = FastAPI(description=description, openapi_tags=tags_metadata)
 
+# Queries a single /predict/batch request may hold.
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 100))
+
+# Seconds a request may wait on Spotify before it is answered with the
+# bundled tracks, 0 to wait as long as it takes.
+REQUEST_DEADLINE = float(os.environ.get("REQUEST_DEADLINE", 5))
+
+# Requests handled at once per endpoint, e.g. MAX_CONCURRENT_PREDICT_TOP
+# for /predict/top; requests beyond the limit are shed with a 503.
+concurrency_limits = {
+    path: admission.ConcurrencyLimit(
+        int(
+            os.environ.get(
+                f"MAX_CONCURRENT_{path.strip('/').replace('/', '_').upper()}",
+                os.environ.get("MAX_CONCURRENT_REQUESTS", 64),
+            )
+        ),
+        max_wait=float(os.environ.get("ADMISSION_MAX_WAIT", 0)),
+    )
+    for path in (
+        "/most_listened",
+        "/show_playlist",
+        "/predict",
+        "/predict/top",
+        "/predict/batch",
+        "/recommend",
+    )
+}
+
+
+@app.on_event("startup")
+async def startup():
+
+    # Authentication and warmup call the Spotify API, so they run in the
+    # background and the server accepts requests right away.
+    app.state.warmup = asyncio.get_running_loop().run_in_executor(
+        None, music_model.warmup
+    )
+    app.state.warmup.add_done_callback(_log_warmup_error)
+
+    # Stale playlists and top tracks keep being served while they are
+    # refreshed in the background.
+    app.state.refresher = asyncio.create_task(music_model.refresher.run())
+
+
+def _log_warmup_error(future: asyncio.Future):
+    """ Logs an error that ended the warmup, which would otherwise go unnoticed. """
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Warmup failed", exc_info=future.exception())
+
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+
+    limit = concurrency_limits.get(request.url.path)
+
+    if limit is None:
+        return await call_next(request)
+
+    if not await limit.acquire():
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Too many concurrent requests"},
+            headers={"Retry-After": "1"},
+        )
+
+    try:
+        with admission.request_context(REQUEST_DEADLINE) as state:
+            response = await call_next(request)
+    finally:
+        limit.release()
+
+    # Responses with the bundled tracks instead of the requested ones must
+    # not be cached as if they were the real thing.
+    if state["degraded"]:
+        limit.degraded += 1
+        response.headers["X-Degraded"] = "; ".join(state["degraded"])
+        response.headers["Cache-Control"] = "no-store"
+        if "etag" in response.headers:
+            del response.headers["etag"]
+
+    return response
+
+
+@app.middleware("http")
+async def record_request_time(request: Request, call_next):
+
+    start = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - start
+
+    # Only known routes are used as label, to keep the number of series bounded.
+    path = request.url.path if request.url.path in route_paths else "other"
+    metrics.REQUEST_SECONDS.observe(
+        elapsed, method=request.method, path=path, status=response.status_code
+    )
+    response.headers["X-Process-Time"] = f"{elapsed:.6f}"
+
+    return response
+
+
+def collect_cache_metrics():
+
+    stats = music_model.cache_stats()
+    families = []
+
+    for counter in ("hits", "misses", "evictions"):
+        name = f"music_cache_{counter}_total"
+        families.append(
+            (
+                name,
+                "counter",
+                f"Number of cache {counter}.",
+                [
+                    (name, {"cache": cache}, stats[cache][counter])
+                    for cache in ("tracks", "models")
+                ],
+            )
+        )
+
+    families.append(
+        (
+            "music_cache_size_bytes",
+            "gauge",
+            "Current size of the cache.",
+            [
+                ("music_cache_size_bytes", {"cache": cache}, stats[cache]["size"])
+                for cache in ("tracks", "models")
+            ],
+        )
+    )
+
+    spotify = stats["spotify"]
+    for counter in ("retries", "rate_limited", "failures"):
+        name = f"spotify_{counter}_total"
+        families.append(
+            (
+                name,
+                "counter",
+                f"Number of Spotify {counter.replace('_', ' ')}.",
+                [(name, {}, spotify[counter])],
+            )
+        )
+
+    for wait in ("throttle", "retry"):
+        name = f"spotify_{wait}_seconds_total"
+        families.append(
+            (
+                name,
+                "counter",
+                f"Seconds Spotify calls waited for the {wait}.",
+                [(name, {}, spotify[f"{wait}_seconds"])],
+            )
+        )
+
+    families.append(
+        (
+            "music_refresh_total",
+            "counter",
+            "Number of background refreshes per outcome.",
+            [
+                ("music_refresh_total", {"outcome": outcome}, stats["refresh"][outcome])
+                for outcome in ("refreshed", "unchanged", "errors")
+            ],
+        )
+    )
+
+    families.append(
+        (
+            "spotify_circuit_open",
+            "gauge",
+            "Whether the circuit breaker stops fetches from Spotify.",
+            [("spotify_circuit_open", {}, int(stats["breaker"]["state"] != "closed"))],
+        )
+    )
+
+    families.append(
+        (
+            "spotify_circuit_opened_total",
+            "counter",
+            "Number of times the circuit breaker opened.",
+            [("spotify_circuit_opened_total", {}, stats["breaker"]["opened"])],
+        )
+    )
+
+    for counter in ("shed", "degraded"):
+        name = f"music_requests_{counter}_total"
+        families.append(
+            (
+                name,
+                "counter",
+                f"Number of {counter} requests per endpoint.",
+                [
+                    (name, {"path": path}, limit.stats()[counter])
+                    for path, limit in concurrency_limits.items()
+                ],
+            )
+        )
+
+    families.append(
+        (
+            "music_requests_in_flight",
+            "gauge",
+            "Number of requests being handled per endpoint.",
+            [
+                ("music_requests_in_flight", {"path": path}, limit.in_flight)
+                for path, limit in concurrency_limits.items()
+            ],
+        )
+    )
+
+    families.append(
+        (
+            "music_tenant_sessions",
+            "gauge",
+            "Number of user sessions.",
+            [("music_tenant_sessions", {}, stats["tenants"]["sessions"])],
+        )
+    )
+
+    families.append(
+        (
+            "music_tenant_cache_size_bytes",
+            "gauge",
+            "Memory used by the top tracks of all users.",
+            [
+                (
+                    "music_tenant_cache_size_bytes",
+                    {},
+                    stats["tenants"]["tracks"]["size"],
+                )
+            ],
+        )
+    )
+
+    return families
+
+
+metrics.REGISTRY.register_collector(collect_cache_metrics)
+
+
+@app.exception_handler(SpotifyException)
+async def spotify_exception_handler(request: Request, error: SpotifyException):
+
+    # Failures of the Spotify API are not failures of the app: rate limits
+    # that outlast the retries become 503 with a Retry-After, the rest 502.
+    # Only a rejected user token is the caller's problem.
+    if error.http_status == 401 and "authorization" in request.headers:
+        return JSONResponse(
+            status_code=401,
+            content={"detail": "Spotify token rejected"},
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    if error.http_status == 429:
+        headers = {
+            k: v for k, v in (error.headers or {}).items() if k.lower() == "retry-after"
+        }
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Spotify rate limit reached"},
+            headers=headers,
+        )
+
+    return JSONResponse(status_code=502, content={"detail": "Spotify API error"})
+
+
+def get_session(request: Request) -> Optional[Session]:
+    """ Returns the session of the user whose Spotify access token is sent as
+    bearer token, or None to use the account of the app.
+    """
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+
+    return music_model.tenants.session(token.strip())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+
+    app.state.refresher.cancel()
+    await music_model.aclose()
+
 
 @app.get("/")
 def root():
@@ -42,21 +380,50 @@ def root():
                        f"{music_model.auth_msg}"}
 
 
+@app.get("/healthz", tags=["health"], summary="Shows whether the app is alive")
+def healthz():
+
+    return {"status": "ok"}
+
+
+@app.get("/readyz", tags=["health"], summary="Shows whether the app is warmed up")
+def readyz():
+
+    if not music_model.ready:
+        return JSONResponse(status_code=503, content={"status": "warming up"})
+
+    return {"status": "ready", **music_model.warmup_status}
+
+
 @app.get(
     "/most_listened",
     tags=["most_listened"],
     summary="Shows your most listened songs",
     response_model=List[Song],
 )
-def get_most_listened_songs(term: Term = Query("short_term"), limit: int = 50, debug: bool = False):
+async def get_most_listened_songs(
+    request: Request,
+    term: Term = Query("short_term"),
+    limit: int = 50,
+    debug: bool = False,
+    session: Optional[Session] = Depends(get_session),
+):
     """ """
-    user_tracks = music_model.read_user_tracks(term)[:limit]
+    user_tracks = await music_model.aread_user_tracks(term, session)
 
-    if debug:
-        return HTMLResponse(
-            content=user_tracks[["name", "artists"]].to_html(), status_code=200
-        )
-    return user_tracks[["name", "artists"]].to_dict(orient="records")
+    headers = cache_headers(
+        request, music_model.version(user_tracks), private=session is not None
+    )
+    if not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+
+    user_tracks = user_tracks[:limit]
+
+    with metrics.timer("serialize"):
+        if debug:
+            html = await run_in_threadpool(user_tracks[["name", "artists"]].to_html)
+            return HTMLResponse(content=html, status_code=200, headers=headers)
+        return await run_in_threadpool(SongsResponse, user_tracks, headers=headers)
 
 
 @app.get(
@@ -65,22 +432,55 @@ def get_most_listened_songs(term: Term = Query("short_term"), limit: int = 50, d
     summary="Shows songs for the given playlist",
     response_model=List[Song],
 )
-def get_songs_from_playlist(
+async def get_songs_from_playlist(
+    request: Request,
     playlist_id: str = "37i9dQZF1DXb5BKLTO7ULa",
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
+    stream: bool = False,
     debug: bool = False,
+    session: Optional[Session] = Depends(get_session),
 ):
-    """ """
+    """ Returns the songs from `offset` on, at most `limit` of them. The
+    X-Total-Count header holds the size of the playlist and X-Next-Offset the
+    offset of the next page, if there is one. With `stream` the songs are
+    sent as newline delimited JSON while they are encoded.
+    """
     try:
-        tracks = music_model.read_tracks(playlist_id)
-    except SpotifyException:
+        tracks = await music_model.aread_tracks(playlist_id, session)
+    except SpotifyException as error:
+        if error.http_status not in (400, 404):
+            raise
         raise HTTPException(status_code=404, detail="Playlist id not found")
 
-    if debug:
-        return HTMLResponse(
-            content=tracks[["name", "artists"]].to_html(), status_code=200
-        )
+    headers = cache_headers(
+        request, music_model.version(tracks), private=Tenants.private(tracks)
+    )
+    if not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+
+    end = len(tracks) if limit is None else min(offset + limit, len(tracks))
+    headers["X-Total-Count"] = str(len(tracks))
+    if end < len(tracks):
+        headers["X-Next-Offset"] = str(end)
 
-    return tracks[["name", "artists"]].to_dict(orient="records")
+    tracks = tracks.iloc[offset:end]
+
+    # Rendering large playlists takes long enough to hold up other requests,
+    # so it runs in the threadpool, like the model fits and queries below.
+    with metrics.timer("serialize"):
+        if debug:
+            html = await run_in_threadpool(tracks[["name", "artists"]].to_html)
+            return HTMLResponse(content=html, status_code=200, headers=headers)
+
+        if stream:
+            return StreamingResponse(
+                iter_songs_ndjson(tracks),
+                media_type="application/x-ndjson",
+                headers=headers,
+            )
+
+        return await run_in_threadpool(SongsResponse, tracks, headers=headers)
 
 
 @app.get(
@@ -89,9 +489,175 @@ def get_songs_from_playlist(
     summary="Shows a prediction based on your music and given playlist",
     response_model=PredOut,
 )
-def get_prediction(
+async def get_prediction(
+    request: Request,
+    response: Response,
     term: Term = Query("short_term"),
     playlist_id: str = "37i9dQZF1DXb5BKLTO7ULa",
+    session: Optional[Session] = Depends(get_session),
 ):
 
-    return music_model.predict(term=term, playlist_id=playlist_id)
+    tracks, user_tracks = await asyncio.gather(
+        music_model.aread_tracks(playlist_id, session),
+        music_model.aread_user_tracks(term, session),
+    )
+
+    headers = cache_headers(
+        request,
+        music_model.version(tracks),
+        music_model.version(user_tracks),
+        private=session is not None,
+    )
+    if not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+
+    response.headers.update(headers)
+
+    return await run_in_threadpool(music_model.match, playlist_id, tracks, user_tracks)
+
+
+@app.get(
+    "/predict/top",
+    tags=["predict"],
+    summary="Shows the k best predictions based on your music and given playlist",
+    response_model=List[RankedPredOut],
+)
+async def get_top_predictions(
+    request: Request,
+    term: Term = Query("short_term"),
+    playlist_id: str = "37i9dQZF1DXb5BKLTO7ULa",
+    k: int = Query(5, ge=1, le=100),
+    per_song: bool = False,
+    session: Optional[Session] = Depends(get_session),
+):
+    """ Returns the k most similar (top song, playlist song) pairs, or the k
+    most similar playlist songs for each of your top songs when `per_song` is set.
+    """
+    tracks, user_tracks = await asyncio.gather(
+        music_model.aread_tracks(playlist_id, session),
+        music_model.aread_user_tracks(term, session),
+    )
+
+    headers = cache_headers(
+        request,
+        music_model.version(tracks),
+        music_model.version(user_tracks),
+        private=session is not None,
+    )
+    if not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+
+    # With `per_song` there are up to 100 predictions per top song. They are
+    # encoded in the threadpool as well, skipping FastAPI's validation of
+    # every item on the event loop; the response model documents the schema.
+    def predict_top() -> ORJSONResponse:
+        return ORJSONResponse(
+            music_model.match_top(playlist_id, tracks, user_tracks, k, per_song),
+            headers=headers,
+        )
+
+    return await run_in_threadpool(predict_top)
+
+
+@app.post(
+    "/predict/batch",
+    tags=["predict"],
+    summary="Shows a prediction for every given term and playlist",
+    response_model=List[PredOut],
+)
+async def get_batch_prediction(
+    queries: conlist(PredIn, max_items=MAX_BATCH_SIZE),
+    session: Optional[Session] = Depends(get_session),
+):
+    """ Returns the predictions in the order of the queries, at most
+    MAX_BATCH_SIZE of them.
+    """
+
+    return await music_model.apredict_batch(
+        [(query.playlist_id, query.term) for query in queries], session
+    )
+
+
+@app.get(
+    "/recommend",
+    tags=["recommend"],
+    summary="Shows the songs across all playlists most similar to your music",
+    response_model=List[CatalogPredOut],
+)
+async def get_recommendations(
+    request: Request,
+    response: Response,
+    term: Term = Query("short_term"),
+    k: int = Query(10, ge=1, le=100),
+    session: Optional[Session] = Depends(get_session),
+):
+
+    user_tracks = await music_model.aread_user_tracks(term, session)
+
+    headers = cache_headers(
+        request,
+        music_model.catalog.version(),
+        music_model.version(user_tracks),
+        private=session is not None,
+    )
+    if not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+
+    response.headers.update(headers)
+
+    return await run_in_threadpool(music_model.match_catalog, user_tracks, k)
+
+
+@app.delete(
+    "/session",
+    tags=["session"],
+    summary="Ends your session and drops your cached top songs",
+)
+def delete_session(session: Optional[Session] = Depends(get_session)):
+
+    if session is None:
+        raise HTTPException(status_code=401, detail="No bearer token given")
+
+    return {"dropped": music_model.tenants.drop(session)}
+
+
+@app.get("/cache_stats", tags=["cache"], summary="Shows the track cache statistics")
+def get_cache_stats():
+
+    return {
+        **music_model.cache_stats(),
+        "admission": {
+            path: limit.stats() for path, limit in concurrency_limits.items()
+        },
+    }
+
+
+@app.get(
+    "/ingest_stats",
+    tags=["cache"],
+    summary="Shows the timing breakdown of recent playlist ingests",
+)
+def get_ingest_stats():
+
+    return music_model.ingest_stats()
+
+
+@app.get(
+    "/memory_stats",
+    tags=["cache"],
+    summary="Shows the memory used by every cached playlist and its model",
+)
+def get_memory_stats():
+
+    return music_model.memory_report()
+
+
+@app.get("/metrics", tags=["metrics"], summary="Shows metrics in Prometheus format")
+def get_metrics():
+
+    return PlainTextResponse(
+        metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
+route_paths = {route.path for route in app.routes}
@@ -0,0 +1,188 @@
+"""
+Minimal Prometheus-style metrics, rendered in the text exposition format on
+the /metrics endpoint. Values are kept per process.
+"""
+
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+class Counter:
+    """ Monotonically increasing value per label set. """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            return [
+                (self.name, dict(zip(self.labelnames, key)), value)
+                for key, value in self._values.items()
+            ]
+
+
+class Histogram:
+    """ Distribution of observed values per label set, in cumulative buckets. """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = (
+            0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+        ),
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+
+        with self._lock:
+            buckets, count, total = self._values.get(
+                key, ([0] * len(self.buckets), 0, 0.0)
+            )
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    buckets[i] += 1
+
+            self._values[key] = (buckets, count + 1, total + value)
+
+    def samples(self) -> List[Sample]:
+        samples = []
+
+        with self._lock:
+            for key, (buckets, count, total) in self._values.items():
+                labels = dict(zip(self.labelnames, key))
+
+                for bound, bucket in zip(self.buckets, buckets):
+                    samples.append(
+                        (f"{self.name}_bucket", {**labels, "le": repr(bound)}, bucket)
+                    )
+
+                samples.append((f"{self.name}_bucket", {**labels, "le": "+Inf"}, count))
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, count))
+
+        return samples
+
+
+class Registry:
+    """ Collection of metrics plus collectors that report values computed at
+    scrape time, such as the cache counters.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, *args, **kwargs) -> Counter:
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+
+        return metric
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+
+        return metric
+
+    def register_collector(
+        self, collect: Callable[[], List[Tuple[str, str, str, List[Sample]]]]
+    ):
+        """ Registers a function that returns (name, kind, documentation, samples)
+        for every metric it reports.
+        """
+        self.collectors.append(collect)
+
+    def render(self) -> str:
+        """ Returns all metrics in the Prometheus text exposition format. """
+        families = [
+            (metric.name, metric.kind, metric.documentation, metric.samples())
+            for metric in self.metrics
+        ]
+
+        for collect in self.collectors:
+            families.extend(collect())
+
+        lines = []
+        for name, kind, documentation, samples in families:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+
+            for sample_name, labels, value in samples:
+                if labels:
+                    label_text = ",".join(
+                        f'{k}="{_escape(v)}"' for k, v in labels.items()
+                    )
+                    lines.append(f"{sample_name}{{{label_text}}} {value}")
+                else:
+                    lines.append(f"{sample_name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    "http_request_duration_seconds",
+    "Time spent handling HTTP requests.",
+    ["method", "path", "status"],
+)
+STAGE_SECONDS = REGISTRY.histogram(
+    "music_stage_duration_seconds",
+    "Time spent per processing stage.",
+    ["stage"],
+)
+SPOTIFY_CALLS = REGISTRY.counter(
+    "spotify_calls_total",
+    "Calls made to the Spotify API.",
+    ["endpoint"],
+)
+BYTES_READ = REGISTRY.counter(
+    "music_store_read_bytes_total",
+    "Bytes read from the on-disk feature store.",
+)
+
+
+@contextmanager
+def timer(stage: str) -> Iterator[None]:
+    """ Records how long the enclosed block takes as the given stage. """
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
@@ -0,0 +1,202 @@
+import asyncio
+import random
+import threading
+import time
+
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import httpx
+import requests
+
+from spotipy.client import SpotifyException
+
+T = TypeVar("T")
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """ Rate limiting and retries for all calls to the Spotify API, shared by
+    the synchronous and the asynchronous client.
+
+    Every call takes a token from a bucket that refills at `rate` tokens per
+    second and holds at most `burst` tokens. Rate limited calls (429) are
+    retried after their Retry-After period, during which all other calls are
+    held back too, because the limit applies to the whole app. Server errors
+    and connection errors are retried with jittered exponential backoff.
+    """
+
+    def __init__(
+        self,
+        rate: float = 20.0,
+        burst: int = 40,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        max_wait: float = 30.0,
+    ):
+        """
+        :param rate: Calls per second, 0 or less to disable the bucket.
+        :param burst: Maximum number of calls made at once after an idle period.
+        :param max_retries: Maximum number of retries per call.
+        :param backoff: Base delay in seconds of the exponential backoff.
+        :param max_wait: Maximum seconds to wait before a retry. A longer
+            Retry-After fails the call right away.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_wait = max_wait
+
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+        self.calls = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self.throttle_seconds = 0.0
+        self.retry_seconds = 0.0
+
+    def reserve(self) -> float:
+        """ Takes a token from the bucket.
+
+        :return: Seconds the caller has to wait before making the call.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.calls += 1
+
+            if self.rate <= 0:
+                delay = max(self._paused_until - now, 0.0)
+            else:
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                self._tokens -= 1
+
+                # A negative balance is paid off by waiting for the refill.
+                delay = max(-self._tokens / self.rate, self._paused_until - now, 0.0)
+
+            self.throttle_seconds += delay
+
+            return delay
+
+    def retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """ Returns how long to wait before retrying a failed call.
+
+        :param error: Exception raised by the call.
+        :param attempt: Number of the failed attempt, starting at 0.
+        :return: Seconds to wait, None if the call should not be retried.
+        """
+        if attempt >= self.max_retries:
+            return None
+
+        if isinstance(error, SpotifyException):
+            if error.http_status not in RETRY_STATUSES:
+                return None
+
+            if error.http_status == 429:
+                retry_after = self._retry_after(error)
+
+                with self._lock:
+                    self.rate_limited += 1
+
+                    if retry_after is not None:
+                        if retry_after > self.max_wait:
+                            return None
+
+                        self._paused_until = max(
+                            self._paused_until, time.monotonic() + retry_after
+                        )
+                        return retry_after
+        elif not isinstance(
+            error, (requests.ConnectionError, requests.Timeout, httpx.TransportError)
+        ):
+            return None
+
+        # Full jitter spreads out the retries of concurrent callers.
+        return random.uniform(0, min(self.max_wait, self.backoff * 2 ** attempt))
+
+    def call(self, fn: Callable[[], T]) -> T:
+        """ Calls fn with rate limiting and retries.
+
+        :param fn: Makes the call to the Spotify API.
+        :return: Result of the call.
+        """
+        attempt = 0
+
+        while True:
+            time.sleep(self.reserve())
+
+            try:
+                return fn()
+            except Exception as error:
+                delay = self._on_error(error, attempt)
+                time.sleep(delay)
+                attempt += 1
+
+    async def acall(self, fn: Callable[[], Awaitable[T]]) -> T:
+        """ Asynchronous variant of `call`.
+
+        :param fn: Returns a coroutine that makes the call to the Spotify API.
+        """
+        attempt = 0
+
+        while True:
+            await asyncio.sleep(self.reserve())
+
+            try:
+                return await fn()
+            except Exception as error:
+                delay = self._on_error(error, attempt)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def _on_error(self, error: Exception, attempt: int) -> float:
+        """ Returns the delay before the next attempt, or raises the error
+        again when the call is not retried.
+        """
+        delay = self.retry_delay(error, attempt)
+
+        with self._lock:
+            if delay is None:
+                self.failures += 1
+                raise error
+
+            self.retries += 1
+            self.retry_seconds += delay
+
+        return delay
+
+    @staticmethod
+    def _retry_after(error: SpotifyException) -> Optional[float]:
+        """ Returns the Retry-After header of a rate limited response in seconds. """
+        headers = {k.lower(): v for k, v in (error.headers or {}).items()}
+
+        try:
+            return float(headers["retry-after"])
+        except (KeyError, ValueError):
+            return None
+
+    def stats(self) -> Dict:
+        """ Returns the configuration and counters of the limiter.
+
+        :return: Dictionary with the number of calls, retries, rate limited
+            responses and failed calls, and the seconds spent waiting.
+        """
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "tokens": self._tokens,
+                "calls": self.calls,
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+                "failures": self.failures,
+                "throttle_seconds": self.throttle_seconds,
+                "retry_seconds": self.retry_seconds,
+            }
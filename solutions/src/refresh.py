@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import threading
+import time
+
+from typing import Callable, Dict, Hashable, List
+
+logger = logging.getLogger(__name__)
+
+
+class Refresher:
+    """ Refreshes stale cache entries in the background while the stale data
+    keeps being served.
+
+    Every read of an entry is recorded with `touch`. An entry is stale once
+    it was last checked more than `max_age` seconds ago, and only entries
+    that were requested since their last check are refreshed: the most
+    requested ones first, at most `concurrency` at a time.
+    """
+
+    def __init__(
+        self,
+        refresh: Callable[[Hashable], bool],
+        max_age: float = 3600,
+        concurrency: int = 2,
+        interval: float = 5,
+    ):
+        """
+        :param refresh: Refreshes the entry with the given key and returns
+            whether its data changed. Runs in a worker thread.
+        :param max_age: Seconds after which an entry is stale.
+        :param concurrency: Maximum number of refreshes running at once.
+        :param interval: Seconds between checks for stale entries.
+        """
+        self.refresh = refresh
+        self.max_age = max_age
+        self.concurrency = concurrency
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._running = set()
+        self.refreshed = 0
+        self.unchanged = 0
+        self.errors = 0
+
+    def touch(self, key: Hashable, updated_at: float):
+        """ Records a request for an entry.
+
+        :param key: Cache key of the entry.
+        :param updated_at: Time at which the stored data was last written.
+        """
+        with self._lock:
+            entry = self._entries.setdefault(key, {"checked_at": 0.0, "requests": 0})
+            entry["checked_at"] = max(entry["checked_at"], updated_at)
+            entry["requests"] += 1
+
+    def stale(self) -> List[Hashable]:
+        """ Returns the keys of the stale entries that were requested since
+        their last check and are not being refreshed, most requested first.
+        """
+        deadline = time.time() - self.max_age
+
+        with self._lock:
+            keys = [
+                key
+                for key, entry in self._entries.items()
+                if entry["checked_at"] < deadline
+                and entry["requests"] > 0
+                and key not in self._running
+            ]
+
+            return sorted(keys, key=lambda k: -self._entries[k]["requests"])
+
+    async def run(self):
+        """ Starts refreshes of stale entries every `interval` seconds, until
+        cancelled.
+        """
+        tasks = set()
+
+        while True:
+            free = self.concurrency - len(self._running)
+
+            for key in self.stale()[:max(free, 0)]:
+                with self._lock:
+                    self._running.add(key)
+
+                task = asyncio.ensure_future(self._refresh(key))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            await asyncio.sleep(self.interval)
+
+    async def _refresh(self, key: Hashable):
+        loop = asyncio.get_running_loop()
+
+        try:
+            changed = await loop.run_in_executor(None, self.refresh, key)
+        except Exception:
+            logger.exception("Refreshing %s failed", key)
+            changed = None
+
+        with self._lock:
+            entry = self._entries[key]
+            entry["checked_at"] = time.time()
+            entry["requests"] = 0
+            self._running.discard(key)
+
+            if changed is None:
+                self.errors += 1
+            elif changed:
+                self.refreshed += 1
+            else:
+                self.unchanged += 1
+
+    def stats(self) -> Dict:
+        """ Returns the number of tracked, stale and refreshing entries and
+        the outcome counters of past refreshes.
+
+        :return: Dictionary with refresh statistics.
+        """
+        stale = len(self.stale())
+
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "stale": stale,
+                "running": len(self._running),
+                "refreshed": self.refreshed,
+                "unchanged": self.unchanged,
+                "errors": self.errors,
+            }
@@ -0,0 +1,60 @@
+"""
+The sklearn engine: a `MinMaxScaler` and `NearestNeighbors` pipeline.
+
+Importing sklearn takes longer than importing the rest of the app, while
+only playlists above `MODEL_ENGINE_THRESHOLD` tracks use it. This module is
+therefore imported on the first fit with this engine instead of at startup.
+"""
+
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from sklearn.neighbors import NearestNeighbors
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import MinMaxScaler
+
+
+class NN(NearestNeighbors):
+    def predict(self, X):
+        return self.kneighbors(X)
+
+
+class Scaler(MinMaxScaler):
+    """ `MinMaxScaler` that scales in float64 also when given the compact
+    float32 features, like the NumPy engine does.
+    """
+
+    def fit(self, X, y=None):
+        return super().fit(X.astype(np.float64), y)
+
+    def transform(self, X):
+        return super().transform(X.astype(np.float64))
+
+
+def fit_pipeline(X: pd.DataFrame) -> Pipeline:
+    """ Returns the pipeline fitted on the given feature columns. """
+    pipeline = Pipeline([("scaler", Scaler()), ("nn", NN(n_neighbors=1))])
+
+    return pipeline.fit(X)
+
+
+def load_pipeline(
+    features: List[str],
+    data_min: List[float],
+    data_max: List[float],
+    scaled: np.ndarray,
+) -> Pipeline:
+    """ Returns the pipeline for an already scaled feature matrix.
+
+    :param features: Names of the feature columns.
+    :param data_min: Minimum of every feature.
+    :param data_max: Maximum of every feature.
+    :param scaled: Scaled feature matrix of the fitted tracks.
+    :return: Fitted pipeline.
+    """
+    # Fitting on the minimum and maximum reproduces the scaler parameters.
+    scaler = Scaler().fit(pd.DataFrame([data_min, data_max], columns=features))
+
+    return Pipeline([("scaler", scaler), ("nn", NN(n_neighbors=1).fit(scaled))])
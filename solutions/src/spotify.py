@@ -1,17 +1,47 @@
+import asyncio
+import glob
+import hashlib
+import logging
+import numpy as np
 import pandas as pd
 import os
+import time
 
-from typing import Dict, List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.neighbors import NearestNeighbors
-from sklearn.pipeline import Pipeline
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, Union
 
+import requests
 import spotipy as sp
 
+from src import admission, feature_store, metrics
+from src.async_spotify import AsyncSpotify
+from src.catalog import CatalogIndex
+from src.circuit_breaker import CircuitBreaker, upstream_failure
+from src.engines import NumpyNN
+from src.rate_limit import RateLimiter
+from src.refresh import Refresher
+from src.tenants import Session, Tenants
+from src.cache import AsyncSingleFlight, LRUCache, SingleFlight
+from src.track_features import TrackFeatureStore
+
+if TYPE_CHECKING:
+    from sklearn.pipeline import Pipeline
+
+logger = logging.getLogger(__name__)
+
+Model = Union["Pipeline", NumpyNN]
+
 
 class MusicModel:
-    def __init__(self):
+    engines = ("auto", "sklearn", "numpy")
+
+    def __init__(self, lazy: bool = False):
+        """
+        :param lazy: Whether to defer authentication to `warmup`, so creating
+            the model does not block on the Spotify API.
+        """
 
         self.redirect_uri = "http://localhost:9000"
         self.scope = "playlist-modify-public user-library-read user-follow-read \
@@ -28,7 +58,85 @@ class MusicModel:
             "valence",
             "tempo",
         ]
-        self.auth_msg = self.authenticate()
+
+        self.cache = LRUCache(
+            max_size=int(os.environ.get("CACHE_MAX_BYTES", 256 * 1024 ** 2)),
+            ttl=float(os.environ.get("CACHE_TTL", 600)),
+            sizeof=lambda df: int(df.memory_usage(deep=True).sum()),
+        )
+        self.models = LRUCache(
+            max_size=int(os.environ.get("MODEL_CACHE_MAX_BYTES", 128 * 1024 ** 2)),
+            sizeof=self._model_nbytes,
+        )
+        self.flights = SingleFlight()
+        self.max_workers = int(os.environ.get("SPOTIFY_WORKERS", 8))
+        self.limiter = RateLimiter(
+            rate=float(os.environ.get("SPOTIFY_RATE", 20)),
+            burst=int(os.environ.get("SPOTIFY_BURST", 40)),
+            max_retries=int(os.environ.get("SPOTIFY_MAX_RETRIES", 3)),
+        )
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.fetch_executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.features_chunk_size = 100
+        self.ingest_timings = deque(maxlen=100)
+        self.async_flights = AsyncSingleFlight()
+        self.catalog = CatalogIndex(self.selected_features)
+
+        # 'numpy' searches brute force, 'sklearn' with a tree and 'auto' picks
+        # NumPy for playlists below the threshold, see benchmarks/engines.py.
+        self.engine = os.environ.get("MODEL_ENGINE", "auto")
+        self.engine_threshold = int(os.environ.get("MODEL_ENGINE_THRESHOLD", 10000))
+
+        if self.engine not in self.engines:
+            raise ValueError(
+                f"Unknown MODEL_ENGINE {self.engine!r}, expected one of {self.engines}"
+            )
+
+        # With a shared store, e.g. on /dev/shm, all worker processes read the
+        # same memory mapped tables and fitted models instead of keeping
+        # their own copies.
+        self.shared_store = bool(os.environ.get("SHARED_STORE_DIR"))
+        self.store_dir = os.environ.get("SHARED_STORE_DIR") or "data"
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        self.track_features = TrackFeatureStore(
+            os.path.join(self.store_dir, "track_features.sqlite"), self.selected_features
+        )
+
+        # Users that send their own Spotify access token get their own top
+        # tracks, kept in memory within a budget shared by all users.
+        self.tenants = Tenants(
+            self.limiter,
+            max_sessions=int(os.environ.get("TENANT_MAX_SESSIONS", 10000)),
+            max_bytes=int(os.environ.get("TENANT_CACHE_MAX_BYTES", 64 * 1024 ** 2)),
+            ttl=float(os.environ.get("TENANT_CACHE_TTL", 600)),
+        )
+
+        # While fetches keep failing, missing tracks fall back to the bundled
+        # ones instead of waiting on Spotify.
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(os.environ.get("BREAKER_FAILURES", 5)),
+            reset_timeout=float(os.environ.get("BREAKER_RESET_SECONDS", 30)),
+        )
+
+        # Stored tracks are served as long as they exist; requested entries
+        # older than REFRESH_MAX_AGE seconds are refreshed in the background.
+        self.refresher = Refresher(
+            self._refresh_entry,
+            max_age=float(os.environ.get("REFRESH_MAX_AGE", 3600)),
+            concurrency=int(os.environ.get("REFRESH_CONCURRENCY", 2)),
+            interval=float(os.environ.get("REFRESH_INTERVAL", 5)),
+        )
+
+        self.ready = False
+        self.warmup_status = {}
+        self.spt = None
+        self.aspt = None
+
+        if lazy:
+            self.auth_msg = "Connecting to the Spotify API, using default data meanwhile."
+        else:
+            self.auth_msg = self.authenticate()
 
     def authenticate(self) -> str:
         """ Authenticates the user using the client_id and client_secret
@@ -36,21 +144,115 @@ class MusicModel:
 
         :return: Message whether authentication was successful.
         """
+        # Retries are left to the limiter, and the connection pool matches
+        # the number of threads that call Spotify concurrently.
+        session = requests.Session()
+        session.mount(
+            "https://",
+            requests.adapters.HTTPAdapter(
+                pool_connections=self.max_workers, pool_maxsize=self.max_workers
+            ),
+        )
+
         try:
             self.spt = sp.Spotify(
                 auth_manager=sp.oauth2.SpotifyOAuth(
                     redirect_uri=self.redirect_uri, scope=self.scope, open_browser=False
-                )
+                ),
+                requests_session=session,
+                requests_timeout=10,
             )
+            self.aspt = AsyncSpotify(self.spt.auth_manager, limiter=self.limiter)
             self.read_user_tracks(term="short_term")
 
             return "Successfully connected to the Spotify API."
 
         except sp.oauth2.SpotifyOauthError:
             self.spt = None
+            self.aspt = None
 
             return "Not able to authenticate, continue with default data."
 
+    def warmup(
+        self, terms: Optional[List[str]] = None, playlist_ids: Optional[List[str]] = None
+    ) -> Dict:
+        """ Authenticates when that has not happened yet, preloads the tracks of
+        the given terms and playlists and fits their models. Stored playlists
+        that changed on Spotify are ingested again. The model reports
+        ready afterwards, also when preloading some of them failed.
+
+        :param terms: Terms to preload, defaults to the WARMUP_TERMS
+            environment variable (comma separated).
+        :param playlist_ids: Playlists to preload, defaults to the
+            WARMUP_PLAYLISTS environment variable (comma separated).
+        :return: Dictionary with the warmup status.
+        """
+        if terms is None:
+            terms = self._env_list("WARMUP_TERMS", "short_term")
+        if playlist_ids is None:
+            playlist_ids = self._env_list("WARMUP_PLAYLISTS", "37i9dQZF1DXb5BKLTO7ULa")
+
+        start = time.perf_counter()
+        errors = []
+
+        if self.spt is None:
+            try:
+                self.auth_msg = self.authenticate()
+            except Exception as error:
+                logger.exception("Authentication failed")
+                errors.append(f"authentication: {error}")
+                self.spt = None
+                self.aspt = None
+                self.auth_msg = "Not able to authenticate, continue with default data."
+
+        for term in terms:
+            try:
+                self.read_user_tracks(term)
+            except Exception as error:
+                logger.exception("Warmup of term %s failed", term)
+                errors.append(f"{term}: {error}")
+
+        for playlist_id in playlist_ids:
+            try:
+                self.refresh_tracks(playlist_id)
+                self.get_model(playlist_id, self.read_tracks(playlist_id))
+            except Exception as error:
+                logger.exception("Warmup of playlist %s failed", playlist_id)
+                errors.append(f"{playlist_id}: {error}")
+
+        try:
+            self.build_catalog()
+        except Exception as error:
+            logger.exception("Building the catalog index failed")
+            errors.append(f"catalog: {error}")
+
+        self.warmup_status = {
+            "terms": terms,
+            "playlists": playlist_ids,
+            "errors": errors,
+            "seconds": time.perf_counter() - start,
+        }
+        self.ready = True
+
+        logger.info("Warmup finished %s", self.warmup_status)
+
+        return self.warmup_status
+
+    @staticmethod
+    def _env_list(name: str, default: str) -> List[str]:
+        """ Returns the comma separated values of an environment variable. """
+        return [
+            value.strip()
+            for value in os.environ.get(name, default).split(",")
+            if value.strip()
+        ]
+
+    async def aclose(self):
+        """ Closes the connection pools of the asynchronous Spotify clients. """
+        if self.aspt:
+            await self.aspt.aclose()
+
+        await self.tenants.aclose()
 
     def read_user_tracks(self, term: str) -> pd.DataFrame:
         """ Returns the top tracks of a user when the user is authenticated.
@@ -60,17 +262,32 @@ class MusicModel:
         :param term: Top user tracks based on the 'short_term', 'medium_term', 'long_term'
         :return: Dataframe containing top songs.
         """
-        file = f"data/user_tracks_{term}.csv"
+        return self._read_cached(
+            key=("user_tracks", term),
+            path=os.path.join(self.store_dir, f"user_tracks_{term}"),
+            fetch=lambda: self.get_top_user_tracks(term),
+            default_path="data/user_tracks",
+        )
 
-        if os.path.isfile(file):
-            return pd.read_csv(file)
+    async def aread_user_tracks(
+        self, term: str, session: Optional[Session] = None
+    ) -> pd.DataFrame:
+        """ Asynchronous variant of `read_user_tracks`. With a session, the top
+        tracks of the session's user are returned instead, cached in memory.
 
-        if self.spt:
-            user_tracks = self.get_top_user_tracks(term)
-            user_tracks.to_csv(file)
-            return user_tracks
+        :param session: Session of the user, see `tenants`.
+        """
+        if session is not None:
+            return await self.tenants.read_user_tracks(
+                session, term, lambda client: self.aget_top_user_tracks(term, client)
+            )
 
-        return pd.read_csv("./data/user_tracks.csv")
+        return await self._aread_cached(
+            key=("user_tracks", term),
+            path=os.path.join(self.store_dir, f"user_tracks_{term}"),
+            fetch=(lambda: self.aget_top_user_tracks(term)) if self.aspt else None,
+            default_path="data/user_tracks",
+        )
 
     def read_tracks(self, playlist_id: str) -> pd.DataFrame:
         """ Returns the tracks of the given playlist if the user is authenticated.
@@ -79,27 +296,555 @@ class MusicModel:
         :param playlist_id: Spotify playlist id.
         :return: Dataframe containing tracks from a given playlist.
         """
-        file = f"data/tracks_{playlist_id}.csv"
+        return self._read_cached(
+            key=("tracks", playlist_id),
+            path=os.path.join(self.store_dir, f"tracks_{playlist_id}"),
+            fetch=lambda: self.get_tracks(playlist_id),
+            default_path="data/tracks",
+        )
+
+    async def aread_tracks(
+        self, playlist_id: str, session: Optional[Session] = None
+    ) -> pd.DataFrame:
+        """ Asynchronous variant of `read_tracks`. Playlists are shared by all
+        users; when the app itself is not authenticated, a missing playlist
+        is fetched with the client of the given session and only cached for
+        that user, since it may be private to them.
+
+        :param session: Session of the user, see `tenants`.
+        """
+        path = os.path.join(self.store_dir, f"tracks_{playlist_id}")
+
+        if self.aspt is None and session is not None and not feature_store.exists(path):
+            try:
+                return await asyncio.wait_for(
+                    self.tenants.read_tracks(
+                        session,
+                        playlist_id,
+                        lambda client: self.aget_tracks(playlist_id, client),
+                    ),
+                    admission.remaining(),
+                )
+            except admission.DEADLINE_ERRORS:
+                self._deadline_exceeded(("tracks", playlist_id))
+
+        return await self._aread_cached(
+            key=("tracks", playlist_id),
+            path=path,
+            fetch=(lambda: self.aget_tracks(playlist_id)) if self.aspt else None,
+            default_path="data/tracks",
+        )
+
+    def refresh_tracks(self, playlist_id: str) -> bool:
+        """ Ingests a playlist again when it changed on Spotify since it was
+        stored, which is detected with its snapshot id. Only the audio
+        features of tracks that were added are fetched.
+
+        :param playlist_id: Spotify playlist id.
+        :return: Whether the playlist was ingested again.
+        """
+        if self.spt is None:
+            return False
+
+        key = ("tracks", playlist_id)
+        path = os.path.join(self.store_dir, f"tracks_{playlist_id}")
+        snapshot_id = self._call(
+            "playlist", self.spt.playlist, playlist_id, fields="snapshot_id"
+        )["snapshot_id"]
+
+        with feature_store.FileLock(path):
+            if feature_store.load_attrs(path).get("snapshot_id") == snapshot_id:
+                return False
+
+            self._write(key, path, self.get_tracks(playlist_id))
+
+        return True
+
+    def refresh_user_tracks(self, term: str) -> bool:
+        """ Fetches the top tracks of a user again and stores them when they
+        changed since they were stored.
+
+        :param term: Top user tracks based on the 'short_term', 'medium_term', 'long_term'
+        :return: Whether the stored top tracks changed.
+        """
+        if self.spt is None:
+            return False
+
+        key = ("user_tracks", term)
+        path = os.path.join(self.store_dir, f"user_tracks_{term}")
+        tracks = self.get_top_user_tracks(term)
+
+        with feature_store.FileLock(path):
+            if feature_store.exists(path) and self._same_tracks(
+                feature_store.load(path), tracks
+            ):
+                return False
+
+            self._write(key, path, tracks)
+
+        return True
+
+    def _refresh_entry(self, key: tuple) -> bool:
+        """ Refreshes the stored tracks with the given cache key, see `refresher`. """
+        if key[0] == "tracks":
+            return self.refresh_tracks(key[1])
+
+        return self.refresh_user_tracks(key[1])
+
+    def _same_tracks(self, stored: pd.DataFrame, tracks: pd.DataFrame) -> bool:
+        """ Returns whether two dataframes contain the same songs and features. """
+        return (
+            len(stored) == len(tracks)
+            and stored["name"].tolist() == tracks["name"].tolist()
+            and stored["artists"].tolist() == tracks["artists"].tolist()
+            and np.array_equal(
+                stored[self.selected_features].to_numpy(dtype=np.float64),
+                tracks[self.selected_features].to_numpy(dtype=np.float64),
+                equal_nan=True,
+            )
+        )
+
+    @staticmethod
+    def version(tracks: pd.DataFrame) -> Optional[list]:
+        """ Returns the version of tracks returned by the read methods: the
+        feature store path they were read from and its modification time.
+        It changes whenever the stored tracks change.
+
+        :param tracks: Dataframe returned by e.g. `read_tracks`.
+        :return: Version, None if unknown.
+        """
+        return tracks.attrs.get("version")
+
+    def cache_stats(self) -> Dict:
+        """ Returns the hit/miss counters of the in-memory track cache and the
+        fitted model registry, plus the statistics of the catalog index, the
+        track feature store, the background refresher and the Spotify rate limiter.
+
+        :return: Dictionary with cache statistics.
+        """
+        return {
+            "tracks": self.cache.stats(),
+            "models": self.models.stats(),
+            "catalog": self.catalog.stats(),
+            "track_features": self.track_features.stats(),
+            "refresh": self.refresher.stats(),
+            "spotify": self.limiter.stats(),
+            "breaker": self.breaker.stats(),
+            "tenants": self.tenants.stats(),
+        }
+
+    def ingest_stats(self) -> List[Dict]:
+        """ Returns the timing breakdown of the most recent playlist ingests.
+
+        :return: List of dictionaries with the number of tracks, pages and
+            feature chunks and the seconds spent per stage.
+        """
+        return list(self.ingest_timings)
+
+    def memory_report(self) -> Dict:
+        """ Returns the memory used by every track table in the in-memory cache,
+        split into the feature matrix, the text columns and the index, plus
+        the fitted model of every playlist. Memory mapped features count in
+        full, although their pages are shared between worker processes, and
+        a model shared by playlists with the same tracks counts for each.
+
+        :return: Dictionary with one entry per table, largest first, and totals.
+        """
+        model_bytes = {key: size for key, _, size in self.models.entries()}
+        tables = []
+
+        for key, tracks, size in self.cache.entries():
+            usage = tracks.memory_usage(deep=True)
+            features = int(usage[self.selected_features].sum())
+            model = model_bytes.get(self._digest(tracks), 0)
+
+            tables.append(
+                {
+                    "table": key[0],
+                    "id": key[1],
+                    "tracks": len(tracks),
+                    "feature_bytes": features,
+                    "text_bytes": int(usage.sum()) - features - int(usage["Index"]),
+                    "index_bytes": int(usage["Index"]),
+                    "model_bytes": model,
+                    "total_bytes": size + model,
+                    "bytes_per_track": (size + model) / max(len(tracks), 1),
+                }
+            )
+
+        tables.sort(key=lambda table: -table["total_bytes"])
+
+        return {
+            "tables": tables,
+            "cache_bytes": self.cache.stats()["size"],
+            "cache_max_bytes": self.cache.max_size,
+            "model_bytes": sum(model_bytes.values()),
+            "model_max_bytes": self.models.max_size,
+        }
+
+    def _read_cached(
+        self, key: tuple, path: str, fetch: Callable, default_path: str
+    ) -> pd.DataFrame:
+        """ Returns the tracks stored under the given path of the feature store,
+        served from the in-memory cache as long as they are unchanged. When
+        nothing is stored, the tracks are fetched from Spotify and stored, or
+        the default tracks are used if the user is not authenticated.
+
+        The default tracks are also used, and the response marked degraded,
+        when the circuit breaker is open or the fetch does not finish before
+        the deadline of the request, see `admission`. The fetch then goes on
+        in the background and stores the tracks for later requests.
+
+        The returned dataframe is shared between requests and must not be
+        modified in place.
+
+        :param key: Cache key.
+        :param path: Feature store path of the cached tracks.
+        :param fetch: Returns the tracks from the Spotify API.
+        :param default_path: Feature store path of the default tracks.
+        :return: Dataframe containing tracks.
+        """
+        mtime = self._version(path)
+
+        if mtime is not None and self.spt:
+            self.refresher.touch(key, mtime / 1e9)
+
+        if mtime is None and self.spt and self._allow_fetch(key):
+            timeout = admission.remaining()
+
+            try:
+                if timeout is None:
+                    return self.flights.do(key, lambda: self._fetch(key, path, fetch))
+
+                return self.fetch_executor.submit(
+                    self.flights.do, key, lambda: self._fetch(key, path, fetch)
+                ).result(timeout=timeout)
+            except admission.DEADLINE_ERRORS:
+                self._deadline_exceeded(key)
+
+        if mtime is None:
+            key, path = ("default", default_path), default_path
+            mtime = self._version(path)
+
+        tracks = self.cache.get(key, mtime)
+
+        if tracks is None:
+            tracks = self._read(key, path, mtime)
+
+        return tracks
+
+    async def _aread_cached(
+        self, key: tuple, path: str, fetch: Callable, default_path: str
+    ) -> pd.DataFrame:
+        """ Asynchronous variant of `_read_cached`. The tracks are fetched with
+        the asynchronous Spotify client and file access runs in a worker thread,
+        so the event loop is never blocked.
+
+        :param fetch: Returns a coroutine that fetches the tracks from the
+            Spotify API, None when no client is authenticated.
+        """
+        loop = asyncio.get_running_loop()
+        mtime = self._mtime(f"{path}.json")
+
+        if mtime is None:
+            mtime = await loop.run_in_executor(None, self._version, path)
+
+        if mtime is not None and self.spt:
+            self.refresher.touch(key, mtime / 1e9)
+
+        if mtime is None and fetch and self._allow_fetch(key):
+            try:
+                return await asyncio.wait_for(
+                    self.async_flights.do(key, lambda: self._afetch(key, path, fetch)),
+                    admission.remaining(),
+                )
+            except admission.DEADLINE_ERRORS:
+                self._deadline_exceeded(key)
+
+        if mtime is None:
+            key, path = ("default", default_path), default_path
+            mtime = await loop.run_in_executor(None, self._version, path)
+
+        tracks = self.cache.get(key, mtime)
+
+        if tracks is None:
+            tracks = await loop.run_in_executor(None, self._read, key, path, mtime)
+
+        return tracks
+
+    def _fetch(self, key: tuple, path: str, fetch: Callable) -> pd.DataFrame:
+        """ Fetches tracks from Spotify and stores them under the given path,
+        unless a concurrent fetch, possibly by another worker process, has
+        stored them in the meantime.
+        """
+        with feature_store.FileLock(path):
+            mtime = self._mtime(f"{path}.json")
+
+            if mtime is not None:
+                return self._read(key, path, mtime)
+
+            tracks = self._record_outcome(fetch)
+            self._write(key, path, tracks)
+
+        return tracks
+
+    async def _afetch(self, key: tuple, path: str, fetch: Callable) -> pd.DataFrame:
+        """ Asynchronous variant of `_fetch`. """
+        loop = asyncio.get_running_loop()
+        lock = feature_store.FileLock(path)
+        await loop.run_in_executor(None, lock.acquire)
+
+        try:
+            mtime = self._mtime(f"{path}.json")
+
+            if mtime is not None:
+                return await loop.run_in_executor(None, self._read, key, path, mtime)
+
+            try:
+                tracks = await fetch()
+            except Exception as error:
+                self._record_failure(error)
+                raise
+
+            self.breaker.record_success()
+            await loop.run_in_executor(None, self._write, key, path, tracks)
+        finally:
+            lock.release()
+
+        return tracks
+
+    def _allow_fetch(self, key: tuple) -> bool:
+        """ Returns whether the circuit breaker lets a fetch through, and
+        otherwise marks the response degraded.
+        """
+        if self.breaker.allow():
+            return True
+
+        admission.mark_degraded(f"{key[0]}: spotify-unavailable")
+
+        return False
+
+    def _deadline_exceeded(self, key: tuple):
+        """ Marks the response degraded when a fetch did not finish before the
+        deadline of the request, which falls back to the default tracks. The
+        fetch goes on in the background and only its own outcome counts for
+        the circuit breaker: a slow fetch does not mean Spotify is failing.
+        """
+        admission.mark_degraded(f"{key[0]}: deadline-exceeded")
+
+    def _record_outcome(self, fetch: Callable) -> pd.DataFrame:
+        """ Calls fetch and records its outcome with the circuit breaker. """
+        try:
+            tracks = fetch()
+        except Exception as error:
+            self._record_failure(error)
+            raise
+
+        self.breaker.record_success()
+
+        return tracks
+
+    def _record_failure(self, error: Exception):
+        """ Records a failed fetch with the circuit breaker. Errors other than
+        an unavailable Spotify API, e.g. unknown ids, mean that Spotify answered.
+        """
+        if upstream_failure(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def _version(self, path: str) -> Optional[int]:
+        """ Returns the version of the tracks stored under the given path. A
+        csv file written by an earlier version is migrated to the feature store
+        on first access.
+
+        :param path: Feature store path of the tracks.
+        :return: Modification time in nanoseconds, None if nothing is stored.
+        """
+        mtime = self._mtime(f"{path}.json")
 
-        if os.path.isfile(file):
-            return pd.read_csv(file)
+        if mtime is None and feature_store.migrate(
+            f"{path}.csv", path, self.selected_features
+        ):
+            mtime = self._mtime(f"{path}.json")
 
-        if self.spt:
-            tracks = self.get_tracks(playlist_id)
-            tracks.to_csv(file)
-            return tracks
+        return mtime
+
+    def _read(self, key: tuple, path: str, mtime: Optional[int]) -> pd.DataFrame:
+        """ Loads tracks from the feature store and stores them in the cache
+        and, for playlists, in the catalog index.
+        """
+        with metrics.timer("store_read"):
+            tracks = feature_store.load(path)
 
-        return pd.read_csv("./data/tracks.csv")
+        self._store(key, tracks, mtime)
+
+        return tracks
+
+    def _write(self, key: tuple, path: str, tracks: pd.DataFrame):
+        """ Writes tracks to the feature store and stores them in the cache
+        and, for playlists, in the catalog index.
+        """
+        with metrics.timer("store_write"):
+            feature_store.save(path, tracks, self.selected_features)
+
+        self._store(key, tracks, self._mtime(f"{path}.json"))
+
+    def _store(self, key: tuple, tracks: pd.DataFrame, mtime: Optional[int]):
+        """ Stores tracks in the cache and, for playlists, in the catalog index.
+        The version is recorded in the attrs of the tracks, see `version`.
+        """
+        tracks.attrs["version"] = [*key, mtime]
+        self.cache.put(key, tracks, mtime)
+
+        if key[0] == "tracks":
+            self.catalog.add(key[1], tracks, mtime)
+
+    def build_catalog(self, data_dir: Optional[str] = None) -> Dict:
+        """ Adds all playlists cached in the feature store to the catalog index,
+        plus the default tracks under the playlist id 'default'.
+
+        :param data_dir: Directory of the feature store, defaults to `store_dir`.
+        :return: Dictionary with the size of the catalog index.
+        """
+        files = glob.glob(os.path.join(data_dir or self.store_dir, "tracks_*.json"))
+        paths = {
+            os.path.basename(file)[len("tracks_"): -len(".json")]: file[: -len(".json")]
+            for file in files
+        }
+
+        if feature_store.exists("data/tracks"):
+            paths["default"] = "data/tracks"
+
+        for playlist_id, path in paths.items():
+            mtime = self._mtime(f"{path}.json")
+
+            if not self.catalog.contains(playlist_id, mtime):
+                self.catalog.add(playlist_id, feature_store.load(path), mtime)
+
+        return self.catalog.stats()
+
+    @staticmethod
+    def _mtime(file: str) -> Optional[int]:
+        """ Returns the modification time of a file.
+
+        :param file: Path of the file.
+        :return: Modification time in nanoseconds, None if the file does not exist.
+        """
+        try:
+            return os.stat(file).st_mtime_ns
+        except FileNotFoundError:
+            return None
 
     def _get_features(self, track_ids: List[str]) -> pd.DataFrame:
-        """ Returns the audio features of a given list of tracks.
+        """ Returns the audio features of a given list of tracks. The ids are
+        split into chunks of at most `features_chunk_size`, which are fetched
+        concurrently.
+
+        :param track_ids: List of Spotify track id's.
+        :return: Dataframe containing audio features, NaN for unknown tracks.
+        """
+        features = self.executor.map(
+            lambda chunk: self._call("audio_features", self.spt.audio_features, chunk),
+            self._chunks(list(track_ids)),
+        )
+
+        return self._parse_features([f for chunk in features for f in chunk])
+
+    async def _aget_features(
+        self, track_ids: List[str], client: Optional[AsyncSpotify] = None
+    ) -> pd.DataFrame:
+        """ Asynchronous variant of `_get_features`.
+
+        :param client: Spotify client to use, the one of the app by default.
+        """
+        client = client or self.aspt
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def get_chunk(chunk):
+            async with semaphore:
+                return await client.audio_features(chunk)
+
+        features = await asyncio.gather(
+            *[get_chunk(chunk) for chunk in self._chunks(list(track_ids))]
+        )
+
+        return self._parse_features([f for chunk in features for f in chunk])
+
+    def _get_cached_features(self, track_ids: List[str]) -> Tuple[pd.DataFrame, int]:
+        """ Returns the audio features of a given list of tracks, fetching only
+        the tracks that are not in the track feature store yet.
+
+        :param track_ids: List of Spotify track id's.
+        :return: Dataframe containing audio features, NaN for unknown tracks,
+            and the number of tracks that were fetched.
+        """
+        known = self.track_features.get(track_ids)
+        missing = self._missing_ids(track_ids, known)
+
+        if missing:
+            known = self._add_features(known, missing, self._get_features(missing))
+
+        return known.reindex(track_ids).reset_index(drop=True), len(missing)
+
+    async def _aget_cached_features(
+        self, track_ids: List[str], client: Optional[AsyncSpotify] = None
+    ) -> Tuple[pd.DataFrame, int]:
+        """ Asynchronous variant of `_get_cached_features`.
+
+        :param client: Spotify client to use, the one of the app by default.
+        """
+        loop = asyncio.get_running_loop()
+        known = await loop.run_in_executor(None, self.track_features.get, track_ids)
+        missing = self._missing_ids(track_ids, known)
+
+        if missing:
+            features = await self._aget_features(missing, client)
+            known = await loop.run_in_executor(
+                None, self._add_features, known, missing, features
+            )
+
+        return known.reindex(track_ids).reset_index(drop=True), len(missing)
+
+    @staticmethod
+    def _missing_ids(track_ids: List[str], known: pd.DataFrame) -> List[str]:
+        """ Returns the unique track ids that are not in the given features. """
+        return [i for i in dict.fromkeys(track_ids) if i not in known.index]
+
+    def _add_features(
+        self, known: pd.DataFrame, missing: List[str], features: pd.DataFrame
+    ) -> pd.DataFrame:
+        """ Stores fetched features in the track feature store.
+
+        :param known: Stored features, indexed by track id.
+        :param missing: Track ids of the fetched features.
+        :param features: Fetched features, in the order of `missing`.
+        :return: Stored and fetched features, indexed by track id.
+        """
+        features.index = pd.Index(missing, name="id")
+        self.track_features.put(features)
+
+        return pd.concat([known, features]) if len(known) else features
+
+    def _chunks(self, track_ids: List[str]) -> List[List[str]]:
+        """ Splits track ids into chunks accepted by the audio features endpoint.
 
         :param track_ids: List of Spotify track id's.
-        :return: Dataframe containing audio features.
+        :return: List of chunks.
         """
-        features = self.spt.audio_features(track_ids)
+        size = self.features_chunk_size
+
+        return [track_ids[i:i + size] for i in range(0, len(track_ids), size)]
 
-        return pd.DataFrame(features)[self.selected_features]
+    def _parse_features(self, features: List[Optional[Dict]]) -> pd.DataFrame:
+        """ Parses audio feature objects from the Spotify API.
+
+        :param features: List of audio feature objects, None for unknown tracks.
+        :return: Dataframe containing the selected audio features.
+        """
+        return pd.DataFrame(
+            [f or {} for f in features], columns=self.selected_features, dtype=float
+        )
 
     def _parse_artist_names(self, artists):
         """ Parses the artists names.
@@ -113,30 +858,130 @@ class MusicModel:
 
         return ", ".join(names)
 
-    def get_tracks(self, playlist_id: str = "4hOKQuZbraPDIfaGbM3lKI") -> pd.DataFrame:
-        """ Returns the tracks of a given playlist.
+    def _parse_tracks(self, items: List[Dict]) -> pd.DataFrame:
+        """ Parses track objects from the Spotify API. Local files and
+        unavailable tracks, which have no id, are skipped.
 
-        :param playlist_id: Spotify playlist id.
-        :return: Dataframe containing songs plus audio features.
+        :param items: List of track objects.
+        :return: Dataframe with the id, name and artists of every track.
         """
-        playlist = self.spt.playlist(playlist_id)
-
-        tracks = pd.DataFrame(
+        return pd.DataFrame(
             [
                 {
-                    "id": i["track"]["id"],
-                    "name": i["track"]["name"],
-                    "artists": self._parse_artist_names(i["track"]["artists"]),
+                    "id": i["id"],
+                    "name": i["name"],
+                    "artists": self._parse_artist_names(i["artists"]),
                 }
-                for i in playlist["tracks"]["items"]
-            ]
+                for i in items
+                if i and i.get("id")
+            ],
+            columns=["id", "name", "artists"],
         )
 
-        return (
-            self._get_features(tracks["id"])
-            .assign(name=tracks["name"])
+    def _with_features(
+        self, tracks: pd.DataFrame, features: pd.DataFrame
+    ) -> pd.DataFrame:
+        """ Combines tracks with their audio features, dropping tracks for
+        which Spotify has no audio features.
+
+        :param tracks: Dataframe with the name and artists of every track.
+        :param features: Dataframe containing audio features, in the same order.
+        :return: Dataframe containing songs plus audio features, in the compact
+            representation of `feature_store.compact`.
+        """
+        tracks = (
+            features.assign(name=tracks["name"])
             .assign(artists=tracks["artists"])
+            .dropna(subset=self.selected_features)
+        )
+
+        return feature_store.compact(tracks, self.selected_features)
+
+    @staticmethod
+    def _page_offsets(page: Dict) -> range:
+        """ Returns the offsets of the pages that follow the given page.
+
+        :param page: First page of a Spotify paging object.
+        :return: Offsets of the remaining pages.
+        """
+        return range(page["offset"] + page["limit"], page["total"], page["limit"])
+
+    def get_tracks(self, playlist_id: str = "4hOKQuZbraPDIfaGbM3lKI") -> pd.DataFrame:
+        """ Returns all tracks of a given playlist. The pages after the first
+        one are fetched concurrently.
+
+        :param playlist_id: Spotify playlist id.
+        :return: Dataframe containing songs plus audio features.
+        """
+        start = time.perf_counter()
+
+        playlist = self._call("playlist", self.spt.playlist, playlist_id)
+        page = playlist["tracks"]
+        pages = [page] + list(
+            self.executor.map(
+                lambda offset: self._call(
+                    "playlist_items",
+                    self.spt.playlist_items,
+                    playlist_id,
+                    offset=offset,
+                    limit=page["limit"],
+                ),
+                self._page_offsets(page),
+            )
         )
+        tracks = self._parse_tracks([i["track"] for p in pages for i in p["items"]])
+        fetched = time.perf_counter()
+
+        features, n_fetched = self._get_cached_features(tracks["id"].tolist())
+        self._record_ingest(
+            playlist_id, len(tracks), len(pages), n_fetched, start, fetched
+        )
+
+        tracks = self._with_features(tracks, features)
+        tracks.attrs["snapshot_id"] = playlist.get("snapshot_id")
+
+        return tracks
+
+    async def aget_tracks(
+        self,
+        playlist_id: str = "4hOKQuZbraPDIfaGbM3lKI",
+        client: Optional[AsyncSpotify] = None,
+    ) -> pd.DataFrame:
+        """ Asynchronous variant of `get_tracks`.
+
+        :param client: Spotify client to use, the one of the app by default.
+        """
+        client = client or self.aspt
+        start = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def get_page(offset):
+            async with semaphore:
+                return await client.playlist_items(
+                    playlist_id, offset=offset, limit=page["limit"]
+                )
+
+        playlist = await client.playlist(playlist_id)
+        page = playlist["tracks"]
+        pages = [page] + list(
+            await asyncio.gather(
+                *[get_page(offset) for offset in self._page_offsets(page)]
+            )
+        )
+        tracks = self._parse_tracks([i["track"] for p in pages for i in p["items"]])
+        fetched = time.perf_counter()
+
+        features, n_fetched = await self._aget_cached_features(
+            tracks["id"].tolist(), client
+        )
+        self._record_ingest(
+            playlist_id, len(tracks), len(pages), n_fetched, start, fetched
+        )
+
+        tracks = self._with_features(tracks, features)
+        tracks.attrs["snapshot_id"] = playlist.get("snapshot_id")
+
+        return tracks
 
     def get_top_user_tracks(self, term: str):
         """ Returns the top user tracks.
@@ -144,39 +989,237 @@ class MusicModel:
         :param term: Top user tracks based on the 'short_term', 'medium_term', 'long_term'
         :return: Dataframe containing top songs plus audio features.
         """
-        top_user_tracks = self.spt.current_user_top_tracks(time_range=term
+        top_user_tracks = self._call(
+            "current_user_top_tracks",
+            self.spt.current_user_top_tracks,
+            time_range=term,
+            limit=50,
         )["items"]
 
-        tracks = pd.DataFrame(
-            [
-                {
-                    "id": i["id"],
-                    "name": i["name"],
-                    "artists": self._parse_artist_names(i["artists"]),
-                }
-                for i in top_user_tracks
-            ],
-        )
+        tracks = self._parse_tracks(top_user_tracks)
 
-        return (
-            self._get_features(tracks["id"])
-            .assign(name=tracks["name"])
-            .assign(artists=tracks["artists"])
-        )
+        features, _ = self._get_cached_features(tracks["id"].tolist())
+
+        return self._with_features(tracks, features)
+
+    async def aget_top_user_tracks(
+        self, term: str, client: Optional[AsyncSpotify] = None
+    ) -> pd.DataFrame:
+        """ Asynchronous variant of `get_top_user_tracks`.
+
+        :param client: Spotify client of the user, the one of the app by default.
+        """
+        client = client or self.aspt
+        top_user_tracks = (
+            await client.current_user_top_tracks(time_range=term, limit=50)
+        )["items"]
+
+        tracks = self._parse_tracks(top_user_tracks)
+
+        features, _ = await self._aget_cached_features(tracks["id"].tolist(), client)
+
+        return self._with_features(tracks, features)
+
+    def _call(self, endpoint: str, fn: Callable, *args, **kwargs):
+        """ Calls the Spotify API through the rate limiter, which retries
+        failed calls, and records every attempt in the metrics.
+
+        :param endpoint: Name of the endpoint, used as metric label.
+        :param fn: Spotipy client method to call.
+        :return: Result of the call.
+        """
+
+        def attempt():
+            metrics.SPOTIFY_CALLS.inc(endpoint=endpoint)
+
+            with metrics.timer(f"spotify_{endpoint}"):
+                return fn(*args, **kwargs)
+
+        return self.limiter.call(attempt)
+
+    def _record_ingest(
+        self,
+        playlist_id: str,
+        n_tracks: int,
+        n_pages: int,
+        n_fetched: int,
+        start: float,
+        fetched: float,
+    ):
+        """ Records and logs how long it took to ingest a playlist.
+
+        :param playlist_id: Spotify playlist id.
+        :param n_tracks: Number of tracks in the playlist.
+        :param n_pages: Number of playlist pages fetched.
+        :param n_fetched: Number of tracks whose audio features were fetched.
+        :param start: Time at which the ingest started.
+        :param fetched: Time at which all playlist pages were fetched.
+        """
+        end = time.perf_counter()
+        timings = {
+            "playlist_id": playlist_id,
+            "tracks": n_tracks,
+            "pages": n_pages,
+            "features_fetched": n_fetched,
+            "feature_chunks": -(-n_fetched // self.features_chunk_size),
+            "playlist_seconds": fetched - start,
+            "features_seconds": end - fetched,
+            "total_seconds": end - start,
+        }
+        self.ingest_timings.append(timings)
+
+        logger.info("Ingested playlist %s", timings)
 
-    def fit_model(self, X: pd.DataFrame) -> Pipeline:
+    def fit_model(self, X: pd.DataFrame) -> Model:
         """ Fits a nearest neighbour model on the given dataset, using the
-        selected features.
+        selected features and the engine chosen for its size.
 
         :param X:
         :return: Fitted model.
         """
-        class NN(NearestNeighbors):
-            def predict(self, X):
-                return self.kneighbors(X)
+        with metrics.timer("fit_model"):
+            if self._use_numpy(len(X)):
+                return NumpyNN(self.selected_features).fit(X)
+
+            from src.sklearn_engine import fit_pipeline
+
+            return fit_pipeline(X[self.selected_features])
+
+    @staticmethod
+    def _load_model_matrix(path: str) -> Tuple[Optional[np.ndarray], Dict]:
+        """ Returns the stored model matrix and its metadata, None and an empty
+        dictionary when no model is stored.
+        """
+        try:
+            return feature_store.load_matrix(path)
+        except FileNotFoundError:
+            return None, {}
+
+    def _use_numpy(self, n_tracks: int) -> bool:
+        """ Returns whether the NumPy engine serves a playlist of the given size. """
+        if self.engine == "auto":
+            return n_tracks < self.engine_threshold
+
+        return self.engine == "numpy"
+
+    def get_model(self, playlist_id: str, tracks: pd.DataFrame) -> Model:
+        """ Returns a fitted nearest neighbour model for the tracks of the given
+        playlist. Fitted models are kept in a registry keyed by a hash of the
+        feature matrix, so a model is only refitted when the playlist data
+        changes, and playlists with the same tracks, e.g. unknown playlists
+        that fall back to the default tracks, share one model.
+
+        :param playlist_id: Spotify playlist id, for logging.
+        :param tracks: Dataframe containing tracks from the playlist.
+        :return: Fitted model.
+        """
+        digest = self._digest(tracks)
+        model = self.models.get(digest)
+
+        if model is None:
+            logger.debug("Fitting the model of playlist %s", playlist_id)
+
+            name = self._model_name(tracks)
+
+            if self.shared_store and name is not None:
+                model = self._load_shared_model(tracks, digest, name)
+            else:
+                model = self.fit_model(tracks)
+            self.models.put(digest, model)
+
+        return model
+
+    def _digest(self, tracks: pd.DataFrame) -> str:
+        """ Returns a hash of the feature matrix of the given tracks. """
+        features = np.ascontiguousarray(tracks[self.selected_features].to_numpy())
+
+        return hashlib.sha1(features.tobytes()).hexdigest()
+
+    @staticmethod
+    def _model_name(tracks: pd.DataFrame) -> Optional[str]:
+        """ Returns the name of the shared model file of tracks read from the
+        feature store, e.g. 'model_tracks_{playlist_id}', None for other tracks
+        such as playlists cached for a single user.
+        """
+        version = tracks.attrs.get("version")
+
+        if version is None or len(version) != 3:
+            return None
+
+        table, name, _ = version
+
+        if table == "tracks":
+            return f"model_tracks_{name}"
+
+        # The default tracks are keyed by their path, e.g. 'data/tracks'.
+        return f"model_{os.path.basename(name)}"
+
+    def _load_shared_model(self, tracks: pd.DataFrame, digest: str, name: str) -> Model:
+        """ Returns a model built from the scaled feature matrix and scaler
+        parameters in the shared store, so the fitted data is memory mapped
+        instead of copied into every worker. The first worker that needs the
+        model fits and stores it.
+
+        There is one model file per stored table, which records the digest of
+        the features it was fitted on. When the table changes, its model is
+        overwritten, so the store does not grow with every change.
+
+        :param tracks: Dataframe containing tracks from the playlist.
+        :param digest: Hash of the feature matrix of the tracks.
+        :param name: Name of the model file, see `_model_name`.
+        :return: Fitted model.
+        """
+        path = os.path.join(self.store_dir, name)
+        scaled, meta = self._load_model_matrix(path)
 
-        pipeline = Pipeline([("scaler", MinMaxScaler()), ("nn", NN(n_neighbors=1))])
-        return pipeline.fit(X[self.selected_features])
+        if meta.get("digest") != digest:
+            with feature_store.FileLock(path):
+                scaled, meta = self._load_model_matrix(path)
+
+                if meta.get("digest") != digest:
+                    model = NumpyNN(self.selected_features).fit(tracks)
+                    feature_store.save_matrix(
+                        path,
+                        model.fit_X_,
+                        {
+                            "digest": digest,
+                            "data_min": model.data_min_.tolist(),
+                            "data_max": model.data_max_.tolist(),
+                        },
+                    )
+                    scaled, meta = feature_store.load_matrix(path)
+
+        if self._use_numpy(len(scaled)):
+            return NumpyNN(self.selected_features).set_params(
+                meta["data_min"], meta["data_max"], scaled=scaled
+            )
+
+        from src.sklearn_engine import load_pipeline
+
+        return load_pipeline(
+            self.selected_features, meta["data_min"], meta["data_max"], scaled
+        )
+
+    @staticmethod
+    def _model_nbytes(model: Model) -> int:
+        """ Returns the approximate memory used by a fitted model.
+
+        :param model: Fitted model.
+        :return: Size in bytes.
+        """
+        if isinstance(model, NumpyNN):
+            return model.nbytes
+
+        scaler, nn = model.named_steps["scaler"], model.named_steps["nn"]
+
+        return (
+            nn._fit_X.nbytes
+            + scaler.min_.nbytes
+            + scaler.scale_.nbytes
+            + scaler.data_min_.nbytes
+            + scaler.data_max_.nbytes
+            + scaler.data_range_.nbytes
+        )
 
     def predict(self, playlist_id: str, term: str) -> Dict:
         """ Returns the most similar song from the given playlist given the top user songs.
@@ -188,20 +1231,314 @@ class MusicModel:
         tracks = self.read_tracks(playlist_id)
         user_tracks = self.read_user_tracks(term)
 
-        nn = self.fit_model(tracks)
+        return self.match(playlist_id, tracks, user_tracks)
+
+    async def apredict(
+        self, playlist_id: str, term: str, session: Optional[Session] = None
+    ) -> Dict:
+        """ Asynchronous variant of `predict`.
+
+        :param session: Session of the user, see `tenants`.
+        """
+        tracks, user_tracks = await asyncio.gather(
+            self.aread_tracks(playlist_id, session),
+            self.aread_user_tracks(term, session),
+        )
+
+        return self.match(playlist_id, tracks, user_tracks)
+
+    def match(
+        self, playlist_id: str, tracks: pd.DataFrame, user_tracks: pd.DataFrame
+    ) -> Dict:
+        """ Returns the most similar song from the given playlist tracks given
+        the top user songs.
+
+        :param playlist_id: Spotify playlist id.
+        :param tracks: Dataframe containing tracks from the playlist.
+        :param user_tracks: Dataframe containing top user songs.
+        :return: Dictionary with the most similar song from the top user song and playlist.
+        """
+        nn = self.get_model(playlist_id, tracks)
+
+        with metrics.timer("kneighbors"):
+            distance, indices = nn.predict(user_tracks[self.selected_features])
+
+        return self._top_match(distance, indices, tracks, user_tracks)
+
+    def predict_top(
+        self, playlist_id: str, term: str, k: int = 5, per_song: bool = False
+    ) -> List[Dict]:
+        """ Returns the k most similar (top user song, playlist song) pairs, or
+        the k most similar playlist songs for every top user song.
+
+        :param playlist_id: Spotify playlist id.
+        :param term: Top user tracks based on the 'short_term', 'medium_term', 'long_term
+        :param k: Number of matches to return.
+        :param per_song: Whether to return k matches per top user song.
+        :return: List of dictionaries with a rank, the top user song, the
+            playlist song and their distance, ordered by rank.
+        """
+        tracks = self.read_tracks(playlist_id)
+        user_tracks = self.read_user_tracks(term)
+
+        return self.match_top(playlist_id, tracks, user_tracks, k, per_song)
+
+    async def apredict_top(
+        self,
+        playlist_id: str,
+        term: str,
+        k: int = 5,
+        per_song: bool = False,
+        session: Optional[Session] = None,
+    ) -> List[Dict]:
+        """ Asynchronous variant of `predict_top`.
+
+        :param session: Session of the user, see `tenants`.
+        """
+        tracks, user_tracks = await asyncio.gather(
+            self.aread_tracks(playlist_id, session),
+            self.aread_user_tracks(term, session),
+        )
+
+        return self.match_top(playlist_id, tracks, user_tracks, k, per_song)
+
+    def match_top(
+        self,
+        playlist_id: str,
+        tracks: pd.DataFrame,
+        user_tracks: pd.DataFrame,
+        k: int = 5,
+        per_song: bool = False,
+    ) -> List[Dict]:
+        """ Returns the k most similar (top user song, playlist song) pairs, or
+        the k most similar playlist songs for every top user song.
+
+        :param playlist_id: Spotify playlist id.
+        :param tracks: Dataframe containing tracks from the playlist.
+        :param user_tracks: Dataframe containing top user songs.
+        :param k: Number of matches to return.
+        :param per_song: Whether to return k matches per top user song.
+        :return: List of dictionaries as returned by `predict_top`.
+        """
+        nn = self.get_model(playlist_id, tracks)
+        k = min(k, len(tracks))
+
+        with metrics.timer("kneighbors"):
+            distance, indices = self._kneighbors(
+                nn, user_tracks[self.selected_features], k
+            )
+
+        if per_song:
+            user_index = np.repeat(np.arange(len(user_tracks)), k)
+            rank = np.tile(np.arange(1, k + 1), len(user_tracks))
+            flat = np.arange(distance.size)
+        else:
+            # The k best pairs are among the k nearest neighbours of every
+            # top song, so only those distances need to be ranked.
+            flat = np.argpartition(distance, k - 1, axis=None)[:k]
+            flat = flat[np.argsort(distance.flat[flat])]
+            user_index = flat // k
+            rank = np.arange(1, len(flat) + 1)
 
-        distance, indices = nn.predict(user_tracks[self.selected_features])
-        df = pd.DataFrame(
-            {"distance": [x[0] for x in distance], "track_id": [x[0] for x in indices]}
+        user_songs = self._song_labels(user_tracks)
+        songs = self._song_labels(tracks)
+
+        return [
+            {
+                "favourite_song": user_songs[u],
+                "most_similar_song": songs[t],
+                "distance": float(d),
+                "rank": int(r),
+            }
+            for r, u, t, d in zip(
+                rank, user_index, indices.flat[flat], distance.flat[flat]
+            )
+        ]
+
+    @staticmethod
+    def _kneighbors(
+        model: Model, X: pd.DataFrame, k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """ Returns the distances and positions of the k nearest tracks for
+        every given track, with either engine.
+        """
+        if isinstance(model, NumpyNN):
+            return model.kneighbors(X, n_neighbors=k)
+
+        return model.named_steps["nn"].kneighbors(
+            model.named_steps["scaler"].transform(X), n_neighbors=k
         )
-        prediction = df.sort_values("distance").reset_index()
 
-        top_match = prediction.iloc[0]
+    def predict_batch(self, queries: List[Tuple[str, str]]) -> List[Dict]:
+        """ Returns the most similar song for every (playlist_id, term) pair.
+        Every playlist and term is loaded once, and all terms requested for
+        the same playlist are queried with a single neighbour search.
+
+        :param queries: List of (playlist id, term) pairs.
+        :return: List of dictionaries as returned by `predict`, in input order.
+        """
+        user_tracks = {
+            term: self.read_user_tracks(term) for term in {term for _, term in queries}
+        }
+        tracks = {
+            playlist_id: self.read_tracks(playlist_id)
+            for playlist_id in {playlist_id for playlist_id, _ in queries}
+        }
+
+        return self.match_batch(queries, tracks, user_tracks)
+
+    async def apredict_batch(
+        self, queries: List[Tuple[str, str]], session: Optional[Session] = None
+    ) -> List[Dict]:
+        """ Asynchronous variant of `predict_batch`. All distinct playlists and
+        terms are loaded concurrently, and the models are fitted and queried
+        in a worker thread.
+
+        :param session: Session of the user, see `tenants`.
+        """
+        terms = list({term: None for _, term in queries})
+        playlist_ids = list({playlist_id: None for playlist_id, _ in queries})
+
+        loaded = await asyncio.gather(
+            *[self.aread_user_tracks(term, session) for term in terms],
+            *[self.aread_tracks(playlist_id, session) for playlist_id in playlist_ids],
+        )
+
+        return await asyncio.get_running_loop().run_in_executor(
+            None,
+            self.match_batch,
+            queries,
+            dict(zip(playlist_ids, loaded[len(terms):])),
+            dict(zip(terms, loaded[: len(terms)])),
+        )
+
+    def match_batch(
+        self,
+        queries: List[Tuple[str, str]],
+        tracks: Dict[str, pd.DataFrame],
+        user_tracks: Dict[str, pd.DataFrame],
+    ) -> List[Dict]:
+        """ Returns the most similar song for every (playlist_id, term) pair,
+        querying all terms requested for the same playlist with a single
+        neighbour search.
+
+        :param queries: List of (playlist id, term) pairs.
+        :param tracks: Dataframe containing tracks, per playlist id.
+        :param user_tracks: Dataframe containing top user songs, per term.
+        :return: List of dictionaries as returned by `predict`, in input order.
+        """
+        terms_per_playlist = {}
+        for playlist_id, term in queries:
+            terms = terms_per_playlist.setdefault(playlist_id, [])
+            if term not in terms:
+                terms.append(term)
+
+        predictions = {}
+        for playlist_id, terms in terms_per_playlist.items():
+            nn = self.get_model(playlist_id, tracks[playlist_id])
+
+            with metrics.timer("kneighbors"):
+                distance, indices = nn.predict(
+                    pd.concat(
+                        [user_tracks[term][self.selected_features] for term in terms]
+                    )
+                )
+
+            start = 0
+            for term in terms:
+                end = start + len(user_tracks[term])
+                predictions[playlist_id, term] = self._top_match(
+                    distance[start:end],
+                    indices[start:end],
+                    tracks[playlist_id],
+                    user_tracks[term],
+                )
+                start = end
+
+        return [predictions[query] for query in queries]
+
+    def recommend(self, term: str, k: int = 10) -> List[Dict]:
+        """ Returns the k tracks across all cached playlists that are most
+        similar to the top user songs. The top user songs themselves are left out.
+
+        :param term: Top user tracks based on the 'short_term', 'medium_term', 'long_term
+        :param k: Number of tracks to return.
+        :return: List of dictionaries with a rank, the top user song, the
+            recommended song, its playlist and their distance, ordered by rank.
+        """
+        return self.match_catalog(self.read_user_tracks(term), k)
+
+    async def arecommend(
+        self, term: str, k: int = 10, session: Optional[Session] = None
+    ) -> List[Dict]:
+        """ Asynchronous variant of `recommend`.
+
+        :param session: Session of the user, see `tenants`.
+        """
+        return self.match_catalog(await self.aread_user_tracks(term, session), k)
+
+    def match_catalog(self, user_tracks: pd.DataFrame, k: int = 10) -> List[Dict]:
+        """ Returns the k tracks in the catalog index that are most similar to
+        the given top user songs.
+
+        :param user_tracks: Dataframe containing top user songs.
+        :param k: Number of tracks to return.
+        :return: List of dictionaries as returned by `recommend`.
+        """
+        user_songs = self._song_labels(user_tracks)
+
+        return [
+            {
+                "rank": rank,
+                "favourite_song": user_songs[user_index],
+                "most_similar_song": song,
+                "playlist_id": playlist_id,
+                "distance": distance,
+            }
+            for rank, (user_index, song, playlist_id, distance) in enumerate(
+                self.catalog.query(user_tracks, k, exclude=user_songs), start=1
+            )
+        ]
+
+    @staticmethod
+    def _song_labels(tracks: pd.DataFrame) -> List[str]:
+        """ Returns the 'name - artists' label of every track.
+
+        :param tracks: Dataframe containing tracks.
+        :return: List of song labels.
+        """
+        return [
+            f"{name} - {artists}"
+            for name, artists in zip(tracks["name"], tracks["artists"])
+        ]
+
+    @staticmethod
+    def _top_match(
+        distance: np.ndarray,
+        indices: np.ndarray,
+        tracks: pd.DataFrame,
+        user_tracks: pd.DataFrame,
+    ) -> Dict:
+        """ Returns the closest (top user song, playlist song) pair from the
+        result of a neighbour search.
+
+        :param distance: Distances to the nearest playlist songs, per top user song.
+        :param indices: Positions of the nearest playlist songs, per top user song.
+        :param tracks: Dataframe containing tracks from the playlist.
+        :param user_tracks: Dataframe containing top user songs.
+        :return: Dictionary with the most similar song from the top user song and playlist.
+        """
+        user_index = int(np.argmin(distance[:, 0]))
+        track_index = int(indices[user_index, 0])
 
         return {
-            "favourite_song": f"{' - '.join(user_tracks.iloc[int(top_match['index'])][['name', 'artists']].values)}",
-            "most_similar_song": f"{' - '.join(tracks.iloc[int(top_match['track_id'])][['name', 'artists']].values)}",
-            "distance": top_match['distance']
+            "favourite_song": " - ".join(
+                user_tracks.iloc[user_index][["name", "artists"]].values
+            ),
+            "most_similar_song": " - ".join(
+                tracks.iloc[track_index][["name", "artists"]].values
+            ),
+            "distance": float(distance[user_index, 0]),
         }
 
 
@@ -0,0 +1,172 @@
+import hashlib
+import time
+
+from typing import Awaitable, Callable, Dict, Optional
+
+import pandas as pd
+
+from src.async_spotify import AsyncSpotify, TokenAuth
+from src.cache import AsyncSingleFlight, LRUCache
+from src.rate_limit import RateLimiter
+
+
+class Session:
+    """ A user of the app, identified by the Spotify access token sent with
+    their requests.
+    """
+
+    def __init__(self, tenant: str, client: AsyncSpotify):
+        """
+        :param tenant: Hash of the access token, used as cache key.
+        :param client: Spotify client that calls the API as this user.
+        """
+        self.tenant = tenant
+        self.client = client
+
+
+class Tenants:
+    """ Sessions and top tracks of the users of the app.
+
+    The Spotify clients of all sessions share one connection pool and the
+    rate limiter of the app. The top tracks of all users live in a single
+    in-memory cache with a global memory budget, so the least recently
+    active users are evicted first. Playlists, fitted models and audio
+    features do not depend on the user and stay in the shared caches,
+    except playlists fetched with the token of a user: those may be private
+    to the user and are kept in the user's cache too.
+    """
+
+    def __init__(
+        self,
+        limiter: RateLimiter,
+        max_sessions: int = 10000,
+        max_bytes: int = 64 * 1024 ** 2,
+        ttl: Optional[float] = 600,
+    ):
+        """
+        :param limiter: Rate limiter shared with the other Spotify clients.
+        :param max_sessions: Maximum number of sessions kept.
+        :param max_bytes: Memory budget for the tracks of all users.
+        :param ttl: Seconds after which the tracks of a user are fetched again.
+        """
+        self.limiter = limiter
+        self.sessions = LRUCache(max_size=max_sessions)
+        self.tracks = LRUCache(
+            max_size=max_bytes,
+            ttl=ttl,
+            sizeof=lambda df: int(df.memory_usage(deep=True).sum()),
+        )
+        self.flights = AsyncSingleFlight()
+        self.client = None
+
+    def session(self, access_token: str) -> Session:
+        """ Returns the session of the user with the given access token.
+
+        :param access_token: Spotify access token of the user.
+        :return: Session of the user.
+        """
+        tenant = hashlib.sha256(access_token.encode()).hexdigest()[:32]
+        session = self.sessions.get(tenant)
+
+        if session is None:
+            if self.client is None:
+                self.client = AsyncSpotify(TokenAuth(""), limiter=self.limiter)
+
+            session = Session(tenant, self.client.with_auth(TokenAuth(access_token)))
+            self.sessions.put(tenant, session)
+
+        return session
+
+    async def read_user_tracks(
+        self,
+        session: Session,
+        term: str,
+        fetch: Callable[[AsyncSpotify], Awaitable[pd.DataFrame]],
+    ) -> pd.DataFrame:
+        """ Returns the top tracks of a user, from the cache or fetched with
+        the client of the user's session.
+
+        :param session: Session of the user.
+        :param term: Top user tracks based on the 'short_term', 'medium_term', 'long_term'
+        :param fetch: Returns a coroutine that fetches the top tracks with the given client.
+        :return: Dataframe containing top songs.
+        """
+        return await self._read(session, "user_tracks", term, fetch)
+
+    async def read_tracks(
+        self,
+        session: Session,
+        playlist_id: str,
+        fetch: Callable[[AsyncSpotify], Awaitable[pd.DataFrame]],
+    ) -> pd.DataFrame:
+        """ Returns a playlist fetched with the client of the user's session.
+        The playlist may be private to the user, so it is only cached for
+        this user and never stored in the shared feature store or catalog.
+
+        :param session: Session of the user.
+        :param playlist_id: Spotify playlist id.
+        :param fetch: Returns a coroutine that fetches the playlist with the given client.
+        :return: Dataframe containing tracks from the playlist.
+        """
+        return await self._read(session, "tracks", playlist_id, fetch)
+
+    @staticmethod
+    def private(tracks: pd.DataFrame) -> bool:
+        """ Returns whether tracks were returned for a single user. """
+        return tracks.attrs.get("private", False)
+
+    async def _read(
+        self,
+        session: Session,
+        table: str,
+        name: str,
+        fetch: Callable[[AsyncSpotify], Awaitable[pd.DataFrame]],
+    ) -> pd.DataFrame:
+        key = (session.tenant, table, name)
+        tracks = self.tracks.get(key)
+
+        if tracks is None:
+            tracks = await self.flights.do(key, lambda: self._fetch(key, session, fetch))
+
+        return tracks
+
+    async def _fetch(
+        self,
+        key: tuple,
+        session: Session,
+        fetch: Callable[[AsyncSpotify], Awaitable[pd.DataFrame]],
+    ) -> pd.DataFrame:
+        tenant, table, name = key
+        tracks = await fetch(session.client)
+        tracks.attrs["version"] = [table, tenant, name, time.time_ns()]
+        tracks.attrs["private"] = True
+        self.tracks.put(key, tracks)
+
+        return tracks
+
+    def drop(self, session: Session) -> int:
+        """ Ends a session and drops the cached tracks of its user.
+
+        :param session: Session of the user.
+        :return: Number of dropped cache entries.
+        """
+        self.sessions.invalidate(session.tenant)
+
+        return self.tracks.invalidate_where(lambda key: key[0] == session.tenant)
+
+    def stats(self) -> Dict:
+        """ Returns the number of sessions and the statistics of the cache
+        with the tracks of all users.
+
+        :return: Dictionary with tenant statistics.
+        """
+        return {
+            "sessions": self.sessions.stats()["entries"],
+            "max_sessions": self.sessions.max_size,
+            "tracks": self.tracks.stats(),
+        }
+
+    async def aclose(self):
+        """ Closes the connection pool shared by the sessions. """
+        if self.client:
+            await self.client.aclose()
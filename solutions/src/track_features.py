@@ -0,0 +1,101 @@
+import sqlite3
+import threading
+
+from typing import Dict, Iterable, List
+
+import pandas as pd
+
+
+class TrackFeatureStore:
+    """ Audio features per Spotify track id, stored in SQLite and shared by
+    all playlists, so a track is fetched from Spotify only once. Tracks
+    without audio features are stored with NULL features, so they are not
+    requested again either.
+
+    The database runs in WAL mode, so worker processes that share the file
+    can read while another one writes.
+    """
+
+    def __init__(self, file: str, features: List[str]):
+        """
+        :param file: Path of the SQLite database.
+        :param features: Names of the feature columns.
+        """
+        self.file = file
+        self.features = features
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(file, timeout=30, check_same_thread=False)
+
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS track_features "
+                f"(id TEXT PRIMARY KEY, {', '.join(f'{f} REAL' for f in features)})"
+            )
+
+    def get(self, track_ids: Iterable[str]) -> pd.DataFrame:
+        """ Returns the stored features of the given tracks.
+
+        :param track_ids: Spotify track ids.
+        :return: Dataframe indexed by track id, containing only the stored tracks.
+        """
+        ids = list(dict.fromkeys(track_ids))
+        rows = []
+
+        with self._lock:
+            # Stay below SQLite's limit on the number of query parameters.
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                rows.extend(
+                    self._conn.execute(
+                        f"SELECT id, {', '.join(self.features)} FROM track_features "
+                        f"WHERE id IN ({', '.join('?' * len(chunk))})",
+                        chunk,
+                    ).fetchall()
+                )
+
+            self.hits += len(rows)
+            self.misses += len(ids) - len(rows)
+
+        return pd.DataFrame.from_records(
+            rows, columns=["id", *self.features], index="id"
+        ).astype(float)
+
+    def put(self, features: pd.DataFrame):
+        """ Stores features, replacing those stored earlier for the same tracks.
+
+        :param features: Dataframe indexed by track id, NaN for tracks without features.
+        """
+        rows = (
+            features[self.features]
+            .astype(object)
+            .where(features[self.features].notna(), None)
+            .itertuples(name=None)
+        )
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO track_features (id, {', '.join(self.features)}) "
+                f"VALUES ({', '.join('?' * (len(self.features) + 1))})",
+                rows,
+            )
+
+    def clear(self):
+        """ Removes all stored features. """
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM track_features")
+
+    def stats(self) -> Dict:
+        """ Returns the number of stored tracks and the lookup counters.
+
+        :return: Dictionary with the number of tracks, hits and misses.
+        """
+        with self._lock:
+            (tracks,) = self._conn.execute(
+                "SELECT COUNT(*) FROM track_features"
+            ).fetchone()
+
+            return {"tracks": tracks, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,40 @@
+import os
+import shutil
+import threading
+
+import pytest
+
+from benchmarks.fake_spotify import FakeSpotify
+from src import batch
+from src.spotify import MusicModel
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+
+
+@pytest.fixture
+def music_model(tmp_path, monkeypatch):
+    shutil.copytree(DATA, tmp_path / "data")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("SPOTIFY_WORKERS", "2")
+
+    music_model = MusicModel(lazy=True)
+    music_model.spt = FakeSpotify(playlist_size=150, latency=0.01)
+
+    return music_model
+
+
+def test_ingest_more_playlists_than_workers(music_model):
+    queries = [(f"playlist{i}", "short_term") for i in range(10)]
+    result = {}
+
+    thread = threading.Thread(
+        target=lambda: result.update(errors=batch.ingest(music_model, queries)),
+        daemon=True,
+    )
+    thread.start()
+    thread.join(timeout=30)
+
+    assert not thread.is_alive(), "ingest deadlocked"
+    assert result["errors"] == {}
+    for playlist_id, _ in queries:
+        assert os.path.isfile(f"data/tracks_{playlist_id}.json")